@@ -0,0 +1,98 @@
+"""
+Times the RGEALTI .asc slab reader against the pandas based reader it replaced, on a synthetic slab.
+Requires the mage_procgen module to be installed (pip install .):
+
+    python benchmarks/asc_reader.py --size 1000 --repeat 3
+"""
+
+import os
+import argparse
+import tempfile
+import timeit
+
+import numpy as np
+import pandas as p
+
+from mage_procgen.Parser.ASCParser import ASCParser
+
+
+def write_synthetic_slab(file_path: str, size: int, seed: int = 0):
+    """
+    Writes a square slab with the layout of the RGEALTI files: a 6 lines header, then one line per row of points, each
+    value being preceded by a space.
+    :param file_path: path of the .asc file to write
+    :param size: number of points of each side of the slab
+    :param seed: seed of the random heights
+    """
+    heights = np.random.default_rng(seed).uniform(0, 300, (size, size))
+
+    with open(file_path, "w") as f:
+        f.write("ncols        " + str(size) + "\n")
+        f.write("nrows        " + str(size) + "\n")
+        f.write("xllcorner    699999.500000000000\n")
+        f.write("yllcorner    6800000.50000000000\n")
+        f.write("cellsize     1.000000000000\n")
+        f.write("NODATA_value  -99999.00\n")
+        for row in heights:
+            f.write(" " + " ".join(["%.2f" % x for x in row]) + "\n")
+
+
+def read_slab_pandas(file_path: str) -> p.DataFrame:
+    """
+    Reader used before ASCParser.read_slab: every line is read as a single csv field, then split in Python
+    """
+    file_data = p.read_csv(file_path)
+
+    # Cleaning the data
+    file_data = file_data.drop([0, 1, 2, 3, 4])
+
+    terrain_pts_list = []
+
+    for line in file_data.values:
+        point_list = [float(x) for x in line[0].split(" ")[1:]]
+        terrain_pts_list.append(point_list)
+
+    return p.DataFrame(terrain_pts_list)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument(
+        "--size", type=int, default=1000, help="points per side of the slab"
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed reads")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        file_path = os.path.join(folder, "slab.asc")
+        write_synthetic_slab(file_path, args.size)
+
+        old_grid = read_slab_pandas(file_path).values
+        new_grid = ASCParser.read_slab(file_path).data.values
+        if not np.allclose(old_grid, new_grid):
+            raise ValueError("The readers don't return the same grid")
+
+        print(
+            "Slab of "
+            + str(args.size)
+            + "x"
+            + str(args.size)
+            + " points, "
+            + str(round(os.path.getsize(file_path) / 1e6, 1))
+            + " MB"
+        )
+
+        for name, read_function in [
+            ("pandas", read_slab_pandas),
+            ("read_slab", ASCParser.read_slab),
+        ]:
+            duration = min(
+                timeit.repeat(
+                    lambda: read_function(file_path), number=1, repeat=args.repeat
+                )
+            )
+            print(name.ljust(10) + str(round(duration, 3)) + " s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,5 @@
+import dataclasses
+
 import jsonpickle
 
 
@@ -14,4 +16,14 @@ class ConfigLoader:
             json_dump = f.read()
 
         config = jsonpickle.decode(json_dump)
+
+        # Config files written before a parameter was added do not have it, so we give it its default value
+        for field in dataclasses.fields(config):
+            if field.name in vars(config):
+                continue
+            if field.default is not dataclasses.MISSING:
+                setattr(config, field.name, field.default)
+            elif field.default_factory is not dataclasses.MISSING:
+                setattr(config, field.name, field.default_factory())
+
         return config
@@ -1,49 +1,219 @@
 import os
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as p
+import shapely
 
 from mage_procgen.Parser.ShapeFileParser import ShapeFileParser, RoadShapeFileParser
 from mage_procgen.Parser.ASCParser import ASCParser
 from mage_procgen.Parser.JP2Parser import JP2Parser
 
-from mage_procgen.Utils.Utils import GeoWindow, GeoData, CRS_fr, CRS_degrees
+from mage_procgen.Utils.Utils import (
+    GeoWindow,
+    GeoData,
+    TerrainMosaic,
+    CRS_fr,
+    CRS_degrees,
+)
+from mage_procgen.Utils.Config import Config
+from mage_procgen.Utils.Cache import TerrainTileCache, TextureCache
 import mage_procgen.Utils.DataFiles as df
 
 
 class Loader:
+    _buildings = "buildings"
+    _forests = "forests"
+    _roads = "roads"
+    _water = "water"
+    _departements = "departements"
+
+    # Columns used by the processing of each layer
+    _layer_columns = {
+        _buildings: df.building_columns,
+        _forests: df.forest_columns,
+        _roads: df.road_columns,
+        _water: df.water_columns,
+        _departements: df.dpt_columns,
+    }
+
     @staticmethod
-    def load(base_folder: str, geo_window: GeoWindow) -> GeoData:
+    def load(base_folder: str, geo_window: GeoWindow, config: Config) -> GeoData:
 
         bbox = geo_window.bounds
 
         print("Loading shp files")
 
-        arrondissements = ShapeFileParser.load(
-            os.path.join(base_folder, df.regions_file),
-            bbox,
-            CRS_fr,
+        departements_names = RegionsIndex.get(
+            os.path.join(base_folder, df.regions_file)
+        ).departements(bbox)
+
+        oceans_data = None
+
+        load_oceans = False
+
+        # Shapefile reads release the GIL, so all the layers of all the departements are read concurrently
+        with ThreadPoolExecutor(
+            max_workers=max(1, config.shapefile_load_workers)
+        ) as executor:
+
+            layer_futures = {
+                Loader._buildings: [],
+                Loader._forests: [],
+                Loader._roads: [],
+                Loader._water: [],
+                Loader._departements: [],
+            }
+
+            for current_departement in departements_names:
+
+                current_bdtopo_folder = os.path.join(
+                    base_folder,
+                    df.departements,
+                    current_departement,
+                    df.bdtopo_folder,
+                    df.delivery,
+                )
+
+                layer_futures[Loader._buildings].append(
+                    executor.submit(
+                        ShapeFileParser.load,
+                        os.path.join(
+                            current_bdtopo_folder, df.building_folder, df.building_file
+                        ),
+                        bbox,
+                        CRS_fr,
+                        columns=Loader._layer_columns[Loader._buildings],
+                    )
+                )
+
+                layer_futures[Loader._forests].append(
+                    executor.submit(
+                        ShapeFileParser.load,
+                        os.path.join(
+                            current_bdtopo_folder, df.forest_folder, df.forest_file
+                        ),
+                        bbox,
+                        CRS_fr,
+                        columns=Loader._layer_columns[Loader._forests],
+                    )
+                )
+
+                layer_futures[Loader._roads].append(
+                    executor.submit(
+                        RoadShapeFileParser.load,
+                        os.path.join(
+                            current_bdtopo_folder, df.road_folder, df.road_file
+                        ),
+                        bbox,
+                        CRS_fr,
+                        columns=Loader._layer_columns[Loader._roads],
+                    )
+                )
+
+                layer_futures[Loader._water].append(
+                    executor.submit(
+                        ShapeFileParser.load,
+                        os.path.join(
+                            current_bdtopo_folder, df.water_folder, df.water_file
+                        ),
+                        bbox,
+                        CRS_fr,
+                        columns=Loader._layer_columns[Loader._water],
+                        force_2d=True,
+                    )
+                )
+
+                layer_futures[Loader._departements].append(
+                    executor.submit(
+                        ShapeFileParser.load,
+                        os.path.join(current_bdtopo_folder, df.dpt_folder, df.dpt_file),
+                        bbox,
+                        CRS_fr,
+                        columns=Loader._layer_columns[Loader._departements],
+                        force_2d=True,
+                    )
+                )
+
+                if os.path.isfile(
+                    os.path.join(current_bdtopo_folder, df.water_folder, df.shore_file)
+                ):
+                    load_oceans = True
+
+            # Terrain is loaded while the shapefiles are being read
+            terrain_data = Loader.load_terrain(
+                base_folder, geo_window, config, departements_names
+            )
+
+            # Concatenating once all the departements are loaded
+            layers_data = {
+                layer: p.concat([x.result() for x in futures])
+                for layer, futures in layer_futures.items()
+            }
+
+        if load_oceans:
+            # Ocean file is in degrees so we have to convert the box back to this csr
+            ocean_box = geo_window.dataframe.to_crs(CRS_degrees).geometry[0].bounds
+            oceans_data = ShapeFileParser.load(
+                os.path.join(base_folder, df.ocean_file),
+                ocean_box,
+                CRS_fr,
+                force_2d=True,
+                columns=df.ocean_columns,
+            )
+
+        geo_data = GeoData(
+            layers_data[Loader._buildings],
+            layers_data[Loader._forests],
+            layers_data[Loader._roads],
+            layers_data[Loader._water],
+            oceans_data,
+            layers_data[Loader._departements],
+            terrain_data,
         )
 
-        departements_names = set(arrondissements["CODE_DEPT"].values)
+        return geo_data
+
+    @staticmethod
+    def load_terrain(
+        base_folder: str,
+        geo_window: GeoWindow,
+        config: Config,
+        departements_names: list[str] = None,
+    ) -> TerrainMosaic:
+        """
+        Loads the terrain of a window
+        :param base_folder: base folder of the application
+        :param geo_window: the window of the scene
+        :param config: the config of the scene
+        :param departements_names: the departements intersecting the window. If None, they are looked up.
+        :return: the terrain of the window
+        """
+        bbox = geo_window.bounds
+
+        if departements_names is None:
+            departements_names = RegionsIndex.get(
+                os.path.join(base_folder, df.regions_file)
+            ).departements(bbox)
+
+        tile_cache = None
+        if config.terrain_cache_size > 0:
+            tile_cache = TerrainTileCache(
+                os.path.join(base_folder, df.cache_folder, df.terrain_cache_folder),
+                config.terrain_cache_size * 1e6,
+            )
 
-        building_data = None
-        forest_data = None
-        road_data = None
-        water_data = None
-        oceans_data = None
-        departements_data = None
         terrain_data = []
 
-        load_oceans = False
+        # Specifically for terrain, we have to make sure it loads a complete rectangle
+        terrain_window = GeoWindow.from_square(
+            bbox[0], bbox[2], bbox[1], bbox[3], CRS_fr, CRS_fr
+        )
 
         for current_departement in departements_names:
 
-            print("Loading data for departement " + current_departement)
+            print("Loading terrain for departement " + current_departement)
 
-            # Specifically for terrain, we have to make sure it loads a complete rectangle
-            terrain_window = geo_window = GeoWindow.from_square(
-                bbox[0], bbox[2], bbox[1], bbox[3], CRS_fr, CRS_fr
-            )
             current_terrain_data = ASCParser.load(
                 os.path.join(
                     base_folder,
@@ -63,138 +233,50 @@ class Loader:
                     df.terrain_data_folder,
                     df.slab_file,
                 ),
+                tile_cache,
+                config.terrain_crop_margin if config.crop_terrain else None,
+                config.terrain_resolution,
+                config.terrain_load_workers,
             )
 
             terrain_data.extend(current_terrain_data)
 
-            current_building_data = ShapeFileParser.load(
-                os.path.join(
-                    base_folder,
-                    df.departements,
-                    current_departement,
-                    df.bdtopo_folder,
-                    df.delivery,
-                    df.building_folder,
-                    df.building_file,
-                ),
-                bbox,
-                CRS_fr,
-            )
-            if building_data is not None:
-                building_data = p.concat([building_data, current_building_data])
-            else:
-                building_data = current_building_data
-
-            current_forest_data = ShapeFileParser.load(
-                os.path.join(
-                    base_folder,
-                    df.departements,
-                    current_departement,
-                    df.bdtopo_folder,
-                    df.delivery,
-                    df.forest_folder,
-                    df.forest_file,
-                ),
-                bbox,
-                CRS_fr,
-            )
-            if forest_data is not None:
-                forest_data = p.concat([forest_data, current_forest_data])
-            else:
-                forest_data = current_forest_data
+        return TerrainMosaic.from_slabs(terrain_data)
 
-            current_road_data = RoadShapeFileParser.load(
-                os.path.join(
-                    base_folder,
-                    df.departements,
-                    current_departement,
-                    df.bdtopo_folder,
-                    df.delivery,
-                    df.road_folder,
-                    df.road_file,
-                ),
-                bbox,
-                CRS_fr,
-            )
-            if road_data is not None:
-                road_data = p.concat([road_data, current_road_data])
-            else:
-                road_data = current_road_data
-
-            current_water_data = ShapeFileParser.load(
-                os.path.join(
-                    base_folder,
-                    df.departements,
-                    current_departement,
-                    df.bdtopo_folder,
-                    df.delivery,
-                    df.water_folder,
-                    df.water_file,
-                ),
-                bbox,
-                CRS_fr,
-                force_2d=True,
+    @staticmethod
+    def input_files(base_folder: str, geo_window: GeoWindow) -> list[str]:
+        """
+        Lists the files the vector data of a window is loaded from
+        :param base_folder: base folder of the application
+        :param geo_window: the window of the scene
+        :return: the paths of the files that exist
+        """
+        regions_file = os.path.join(base_folder, df.regions_file)
+        files = [regions_file, os.path.join(base_folder, df.ocean_file)]
+
+        for current_departement in RegionsIndex.get(regions_file).departements(
+            geo_window.bounds
+        ):
+            current_bdtopo_folder = os.path.join(
+                base_folder,
+                df.departements,
+                current_departement,
+                df.bdtopo_folder,
+                df.delivery,
             )
-            if water_data is not None:
-                water_data = p.concat([water_data, current_water_data])
-            else:
-                water_data = current_water_data
 
-            current_departement_data = ShapeFileParser.load(
+            files += [
                 os.path.join(
-                    base_folder,
-                    df.departements,
-                    current_departement,
-                    df.bdtopo_folder,
-                    df.delivery,
-                    df.dpt_folder,
-                    df.dpt_file,
+                    current_bdtopo_folder, df.building_folder, df.building_file
                 ),
-                bbox,
-                CRS_fr,
-                force_2d=True,
-            )
-            if departements_data is not None:
-                departements_data = p.concat(
-                    [departements_data, current_departement_data]
-                )
-            else:
-                departements_data = current_departement_data
-
-            if os.path.isfile(
-                os.path.join(
-                    base_folder,
-                    df.departements,
-                    current_departement,
-                    df.bdtopo_folder,
-                    df.delivery,
-                    df.water_folder,
-                    df.shore_file,
-                )
-            ):
-                load_oceans = True
+                os.path.join(current_bdtopo_folder, df.forest_folder, df.forest_file),
+                os.path.join(current_bdtopo_folder, df.road_folder, df.road_file),
+                os.path.join(current_bdtopo_folder, df.water_folder, df.water_file),
+                os.path.join(current_bdtopo_folder, df.dpt_folder, df.dpt_file),
+                os.path.join(current_bdtopo_folder, df.water_folder, df.shore_file),
+            ]
 
-        if load_oceans:
-            # Ocean file is in degrees so we have to convert the box back to this csr
-            ocean_box = geo_window.dataframe.to_crs(CRS_degrees).geometry[0].bounds
-            oceans_data = ShapeFileParser.load(
-                os.path.join(base_folder, df.ocean_file),
-                ocean_box,
-                CRS_fr,
-                force_2d=True,
-            )
-
-        geo_data = GeoData(
-            building_data,
-            forest_data,
-            road_data,
-            water_data,
-            oceans_data,
-            departements_data,
-            terrain_data,
-        )
-
-        return geo_data
+        return [x for x in files if os.path.isfile(x)]
 
     @staticmethod
     def load_town_shape(base_folder: str, departement_nbr: int, town_name: str):
@@ -219,44 +301,29 @@ class Loader:
 
     @staticmethod
     def load_texture(
-        base_folder: str, mesh_box: tuple[float, float, float, float]
+        base_folder: str,
+        mesh_box: tuple[float, float, float, float],
+        texture_cache: TextureCache,
+        texture_resolution: float = None,
     ) -> str:
-
-        arrondissements = ShapeFileParser.load(
-            os.path.join(base_folder, df.regions_file),
-            mesh_box,
-            CRS_fr,
-        )
-
-        departements = list(set(arrondissements["CODE_DEPT"].values))
+        """
+        Gets the texture of a terrain mesh, creating it from the BDORTHO slabs if it is not in the cache
+        :param base_folder: base folder of the application
+        :param mesh_box: the bounding box of the mesh
+        :param texture_cache: the cache of the textures
+        :param texture_resolution: ground size of a pixel of the texture, in m
+        :return: the path of the texture file
+        """
+
+        departements = RegionsIndex.get(
+            os.path.join(base_folder, df.regions_file)
+        ).departements(mesh_box)
 
         if len(departements) > 1:
             raise ValueError("A single slab cannot be over multiple regions")
 
         current_departement = departements[0]
 
-        current_texture_folder = os.path.join(
-            base_folder, df.departements, df.texture_folder, current_departement
-        )
-
-        if not os.path.isdir(current_texture_folder):
-            os.makedirs(current_texture_folder)
-
-        texture_file_name = (
-            "Texture_"
-            + str(int(mesh_box[0]))
-            + "_"
-            + str(int(mesh_box[1]))
-            + "_"
-            + str(int(mesh_box[2]))
-            + "_"
-            + str(int(mesh_box[3]))
-            + "_"
-            + ".tif"
-        )
-
-        texture_full_path = os.path.join(current_texture_folder, texture_file_name)
-
         current_texture_image_folder = os.path.join(
             base_folder,
             df.departements,
@@ -284,12 +351,59 @@ class Loader:
             CRS_fr,
         )
 
-        if not os.path.isfile(texture_full_path):
-            JP2Parser.create_texture_img(
+        # Textures are recreated if the slabs of the departement change
+        texture_key = TextureCache.file_key(
+            current_texture_image_slab_file,
+            *[int(x) for x in mesh_box],
+            texture_resolution,
+        )
+
+        texture_full_path = texture_cache.get_or_create(
+            texture_key,
+            lambda texture_path: JP2Parser.create_texture_img(
                 current_texture_image_folder,
                 current_terrain_window,
                 current_texture_image_slab_file,
-                texture_full_path,
-            )
+                texture_path,
+                texture_resolution,
+            ),
+        )
 
         return texture_full_path
+
+
+class RegionsIndex:
+    """
+    Spatial index over the regions file, used to find the departements intersecting a bounding box.
+    The file is read once per process, the following lookups are only queries of the index.
+    """
+
+    _departement_column = "CODE_DEPT"
+
+    def __init__(self, regions_file: str):
+        regions = ShapeFileParser.load_no_window(
+            regions_file, CRS_fr, columns=df.regions_columns
+        )
+
+        self._tree = shapely.STRtree(regions.geometry.values)
+        self._departements = regions[self._departement_column].to_numpy()
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def get(regions_file: str) -> "RegionsIndex":
+        """
+        Gets the index of a regions file, building it on first use
+        :param regions_file: the path of the regions file
+        :return: the index of the file
+        """
+        return RegionsIndex(regions_file)
+
+    def departements(self, bbox: tuple[float, float, float, float]) -> list[str]:
+        """
+        Finds the departements intersecting a bounding box
+        :param bbox: the bounding box, as (x_min, y_min, x_max, y_max) in CRS_fr
+        :return: the sorted codes of the departements
+        """
+        regions_indexes = self._tree.query(shapely.box(*bbox), predicate="intersects")
+
+        return sorted(set(self._departements[regions_indexes]))
@@ -1,10 +1,13 @@
+import os
 from bpy import data as D
 import math
 import geopandas as g
 from shapely.geometry import MultiPolygon, Polygon, mapping, LineString
-from mage_procgen.Utils.Utils import PolygonList, TerrainData
+from mage_procgen.Utils.Utils import PolygonList, TerrainMosaic
 from mage_procgen.Utils.Utils import RenderingData, GeoWindow
 from mage_procgen.Utils.Config import Config
+from mage_procgen.Utils.Cache import TextureCache
+import mage_procgen.Utils.DataFiles as df
 from mage_procgen.Utils.Rendering import (
     configure_render,
     rendering_collection_name,
@@ -26,7 +29,7 @@ from mage_procgen.Renderer import (
 class RenderManager:
     def __init__(
         self,
-        terrain_data: list[TerrainData],
+        terrain_data: TerrainMosaic,
         rendering_data: RenderingData,
         geowindow: GeoWindow,
         crs: int,
@@ -40,7 +43,21 @@ class RenderManager:
         self.current_zone = None
         configure_render(self.window.center_deg)
         self.terrain_renderer = TerrainRenderer.TerrainRenderer(
-            config.base_folder, self.config.terrain_resolution, 1
+            config.base_folder,
+            self.config.terrain_resolution,
+            1,
+            TextureCache(
+                os.path.join(
+                    config.base_folder, df.cache_folder, df.texture_cache_folder
+                ),
+                config.texture_cache_size * 1e6,
+            ),
+            (
+                self.config.texture_resolution
+                if self.config.texture_resolution > 0
+                else self.config.out_img_pixel_size
+            ),
+            self.config.texture_load_workers,
         )
         self.building_renderer = BuildingRenderer.BuildingRenderer(
             self.terrain_data, self.config.building_render_config
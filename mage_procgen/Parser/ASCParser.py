@@ -1,19 +1,46 @@
 import os
+import math
+import dataclasses
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
 
+import numpy as np
 import pandas as p
 from mage_procgen.Utils.Utils import TerrainData
-from mage_procgen.Utils.Utils import GeoWindow, CRS_fr
+from mage_procgen.Utils.Utils import GeoWindow, CRS_fr, process_start_method
 from mage_procgen.Utils.DataFiles import file_coords_regex
+from mage_procgen.Utils.Cache import TerrainTileCache
 from mage_procgen.Parser.ShapeFileParser import ShapeFileParser
 
 
 class ASCParser:
+    # ncols, nrows, xllcorner, yllcorner, cellsize, NODATA_value
+    _header_lines = 6
+
     @staticmethod
     def load(
         file_folder: str,
         geo_window: GeoWindow,
         slab_file: str,
+        tile_cache: TerrainTileCache = None,
+        crop_margin: float = None,
+        crop_resolution: float = None,
+        workers: int = 1,
     ):
+        """
+        Loads all the slabs intersecting the window
+        :param file_folder: folder containing the .asc files
+        :param geo_window: the window to load
+        :param slab_file: shapefile describing the slabs
+        :param tile_cache: optional cache of parsed slabs
+        :param crop_margin: if provided, slabs are cropped to the window plus this margin (in m)
+        :param crop_resolution: resolution at which the terrain will be rendered. Cropped slabs keep a number of points
+        that is a multiple of it
+        :param workers: number of processes used to parse the slabs that are not in the cache
+        :return: the list of loaded slabs
+        """
 
         bbox = geo_window.bounds
         slabs = ShapeFileParser.load(slab_file, bbox, CRS_fr)
@@ -21,11 +48,7 @@ class ASCParser:
             geo_window.dataframe, how="intersection", keep_geom_type=True
         )
 
-        # TODO: could extract the region we really want and not the whole slab. Only issue would be with the rendering
-        # resolution because it's much better if it divides the points number. Maybe it needs to be passed here, and
-        # we get the smallest sub-slab that fits "pts_number is a multiple of render resolution"
-
-        loaded_files = []
+        slab_files = []
 
         for index, row in slab_parts.iterrows():
             file_name = os.path.basename(row["NOM_DALLE"]) + ".asc"
@@ -41,94 +64,324 @@ class ASCParser:
                 file_name = next(x for x in os.listdir(file_folder) if file_coords in x)
                 file_full_path = os.path.join(file_folder, file_name)
 
-            file_data = p.read_csv(file_full_path)
+            slab_files.append(file_full_path)
 
-            # Number of columns must be read in dataframe.columns, the rest is in the rows ...
-            nbcols = int(file_data.columns[0].split(" ")[-1])
-            nbrows = int(file_data.values[0][0].split(" ")[-1])
+        loaded_files = [None for _ in slab_files]
 
-            # The x_min and y_min indicated are those of the enveloppe of the raster,
-            # while we're concerned abt the center pixel which is (0.5,0.5) away.
-            x_min = float(file_data.values[1][0].split(" ")[-1]) + 0.5
-            y_min = float(file_data.values[2][0].split(" ")[-1]) + 0.5
+        def add_slab(slab_index: int, terrain_data: TerrainData):
+            if crop_margin is not None:
+                terrain_data = ASCParser.crop(
+                    terrain_data, bbox, crop_margin, crop_resolution
+                )
+            loaded_files[slab_index] = terrain_data
+
+        files_to_parse = []
+
+        for slab_index, file_full_path in enumerate(slab_files):
+            cached_terrain_data = None
+            if tile_cache is not None:
+                cached_terrain_data = tile_cache.get(file_full_path)
+
+            if cached_terrain_data is not None:
+                add_slab(slab_index, cached_terrain_data)
+                print("Loaded slab from cache : " + os.path.basename(file_full_path))
+            else:
+                files_to_parse.append((slab_index, file_full_path))
+
+        # Slabs are only cached whole. Without a cache, only the rows that will be kept by the crop are parsed.
+        read_box = None
+        if crop_margin is not None and tile_cache is None:
+            read_box = bbox
+
+        def add_parsed_slab(slab_index: int, file_full_path: str, terrain_data):
+            if tile_cache is not None:
+                tile_cache.put(file_full_path, terrain_data)
+            add_slab(slab_index, terrain_data)
+            print("Loaded slab : " + os.path.basename(file_full_path))
+
+        if workers > 1 and len(files_to_parse) > 1:
+            with ProcessPoolExecutor(
+                max_workers=min(workers, len(files_to_parse)),
+                mp_context=multiprocessing.get_context(process_start_method),
+            ) as executor:
+                futures = {
+                    executor.submit(
+                        _read_slab_to_shared_memory,
+                        x[1],
+                        read_box,
+                        crop_margin,
+                        crop_resolution,
+                    ): x
+                    for x in files_to_parse
+                }
+
+                pending_futures = set(futures)
+
+                try:
+                    for future in as_completed(futures):
+                        pending_futures.remove(future)
+                        slab_index, file_full_path = futures[future]
+                        terrain_header, shared_memory_name = future.result()
+
+                        add_parsed_slab(
+                            slab_index,
+                            file_full_path,
+                            _terrain_data_from_shared_memory(
+                                terrain_header, shared_memory_name
+                            ),
+                        )
+                except BaseException:
+                    # The workers don't free their blocks, those of the slabs that were not read back have to be freed
+                    for future in pending_futures:
+                        if future.cancel() or future.exception() is not None:
+                            continue
+                        _free_shared_memory(future.result()[1])
+                    raise
+        else:
+            for slab_index, file_full_path in files_to_parse:
+                add_parsed_slab(
+                    slab_index,
+                    file_full_path,
+                    ASCParser.read_slab(
+                        file_full_path, read_box, crop_margin, crop_resolution
+                    ),
+                )
+
+        # Cropping removes the slabs that are only in the margin of the window
+        return [x for x in loaded_files if x is not None]
+
+    @staticmethod
+    def crop(
+        terrain_data: TerrainData,
+        bbox: tuple[float, float, float, float],
+        margin: float,
+        render_resolution: float = None,
+    ) -> TerrainData | None:
+        """
+        Extracts the part of a slab that intersects a bounding box extended by a margin.
+        The extracted part is snapped on a grid of render_resolution, relative to the slab origin, so that the rendering
+        resolution still divides its number of points.
+        :param terrain_data: the slab to crop
+        :param bbox: the bounding box to extract, as (x_min, y_min, x_max, y_max)
+        :param margin: margin added around the bounding box, in m
+        :param render_resolution: resolution at which the terrain will be rendered
+        :return: the cropped slab, or None if the slab does not intersect the extended box
+        """
+
+        resolution = terrain_data.resolution
+
+        col_start, col_end = ASCParser.__crop_indexes(
+            bbox[0] - margin,
+            bbox[2] + margin,
+            terrain_data.x_min,
+            terrain_data.nbcol,
+            resolution,
+            render_resolution,
+        )
+
+        # Indexes counted from the bottom of the slab, so that the grid stays aligned on y_min
+        row_bottom, row_top = ASCParser.__crop_indexes(
+            bbox[1] - margin,
+            bbox[3] + margin,
+            terrain_data.y_min,
+            terrain_data.nbrow,
+            resolution,
+            render_resolution,
+        )
+
+        nbcol = col_end - col_start
+        nbrow = row_top - row_bottom
+
+        if nbcol <= 0 or nbrow <= 0:
+            return None
+
+        # Y axis is pointing north, so the first row of the data is the top of the slab
+        data = terrain_data.data.values[
+            terrain_data.nbrow - row_top : terrain_data.nbrow - row_bottom,
+            col_start:col_end,
+        ]
+
+        x_min = terrain_data.x_min + col_start * resolution
+        y_min = terrain_data.y_min + row_bottom * resolution
+
+        return TerrainData(
+            x_min,
+            y_min,
+            x_min + resolution * nbcol,
+            y_min + resolution * nbrow,
+            resolution,
+            nbcol,
+            nbrow,
+            terrain_data.no_data,
+            p.DataFrame(np.ascontiguousarray(data), copy=False),
+        )
+
+    @staticmethod
+    def __crop_indexes(
+        low: float,
+        high: float,
+        origin: float,
+        count: int,
+        resolution: float,
+        render_resolution: float = None,
+    ) -> tuple[int, int]:
+        """
+        Computes the range of indexes of the points of a slab axis that cover [low, high], snapped on a grid of
+        render_resolution relative to the origin of the axis
+        :return: the first index and the index after the last one
+        """
+        step = 1
+        if render_resolution is not None:
+            step = max(1, int(round(render_resolution / resolution)))
+
+        start = math.floor((low - origin) / resolution / step) * step
+        end = math.ceil((high - origin) / resolution / step) * step
 
-            resolution = float(file_data.values[3][0].split(" ")[-1])
-            no_data = float(file_data.values[4][0].split(" ")[-1])
-            x_max = x_min + resolution * nbcols
-            y_max = y_min + resolution * nbrows
+        return min(max(start, 0), count), min(max(end, 0), count)
 
-            # Cleaning the data
-            file_data = file_data.drop([0, 1, 2, 3, 4])
+    @staticmethod
+    def read_slab(
+        file_path: str,
+        bbox: tuple[float, float, float, float] = None,
+        margin: float = 0,
+        render_resolution: float = None,
+    ) -> TerrainData:
+        """
+        Reads a single RGEALTI .asc slab.
+        The 6 lines header is parsed directly, and the grid is decoded in bulk into a contiguous float32 array.
+        :param file_path: path of the .asc file
+        :param bbox: if provided, only the rows that crop keeps for this bounding box are parsed
+        :param margin: margin added around bbox, in m
+        :param render_resolution: resolution at which the terrain will be rendered, as used by crop
+        :return: the TerrainData of the slab, or of the band of rows parsed
+        """
 
-            terrain_pts_list = []
+        with open(file_path, "rb") as f:
+            header = {}
+            for _ in range(ASCParser._header_lines):
+                key, value = f.readline().split()
+                header[key.decode().lower()] = value.decode()
 
-            for line in file_data.values:
-                point_list = [float(x) for x in line[0].split(" ")[1:]]
-                terrain_pts_list.append(point_list)
+            nbcols = int(header["ncols"])
+            nbrows = int(header["nrows"])
 
-            terrain_data = p.DataFrame(terrain_pts_list)
+            # The x_min and y_min indicated are those of the enveloppe of the raster,
+            # while we're concerned abt the center pixel which is (0.5,0.5) away.
+            x_min = float(header["xllcorner"]) + 0.5
+            y_min = float(header["yllcorner"]) + 0.5
 
-            print("Loaded slab : " + file_name)
+            resolution = float(header["cellsize"])
+            no_data = float(header["nodata_value"])
 
-            loaded_files.append(
-                TerrainData(
-                    x_min,
+            if bbox is None:
+                grid = np.loadtxt(f, dtype=np.float32, ndmin=2)
+            else:
+                row_bottom, row_top = ASCParser.__crop_indexes(
+                    bbox[1] - margin,
+                    bbox[3] + margin,
                     y_min,
-                    x_max,
-                    y_max,
-                    resolution,
-                    nbcols,
                     nbrows,
-                    no_data,
-                    terrain_data,
+                    resolution,
+                    render_resolution,
                 )
-            )
+                row_top = max(row_top, row_bottom)
 
-        # Coherence check: find out if we are missing a slab
-        global_x_min = min([x.x_min for x in loaded_files])
-        global_x_max = max([x.x_max for x in loaded_files])
-        global_y_min = min([x.y_min for x in loaded_files])
-        global_y_max = max([x.y_max for x in loaded_files])
-
-        resolution = loaded_files[0].resolution
-        nbcols = loaded_files[0].nbcol
-        nbrows = loaded_files[0].nbrow
-        no_data = loaded_files[0].no_data
-
-        terrain_data = p.DataFrame([[0 for x in range(nbcols)] for y in range(nbrows)])
-
-        current_x = global_x_min
-        current_y = global_y_min
-        current_terrain = None
-
-        while current_x < global_x_max and current_y < global_y_max:
-
-            for terrain in loaded_files:
-                if current_x == terrain.x_min and current_y == terrain.y_min:
-                    current_terrain = terrain
-                    break
-
-            # If the terrain that is supposed to be there is not, add it
-            if current_terrain is None:
-                loaded_files.append(
-                    TerrainData(
-                        current_x,
-                        current_y,
-                        current_x + resolution * nbcols,
-                        current_y + resolution * nbrows,
-                        resolution,
-                        nbcols,
-                        nbrows,
-                        no_data,
-                        terrain_data,
+                # Y axis is pointing north, so the rows above the band are skipped without being decoded,
+                # and the rows under it are not read at all
+                grid = np.zeros((0, nbcols), dtype=np.float32)
+                if row_top > row_bottom:
+                    grid = np.loadtxt(
+                        f,
+                        dtype=np.float32,
+                        ndmin=2,
+                        skiprows=nbrows - row_top,
+                        max_rows=row_top - row_bottom,
                     )
-                )
 
-            # If we're at the end of a line
-            if current_x >= global_x_max:
-                current_y = current_y + resolution * nbrows
-                current_x = global_x_min
-            else:
-                current_x = current_x + resolution * nbcols
+                nbrows = row_top - row_bottom
+                y_min += resolution * row_bottom
+
+        if grid.shape != (nbrows, nbcols):
+            raise ValueError(
+                "Invalid slab "
+                + file_path
+                + ": expected "
+                + str((nbrows, nbcols))
+                + " points, got "
+                + str(grid.shape)
+            )
+
+        x_max = x_min + resolution * nbcols
+        y_max = y_min + resolution * nbrows
+
+        return TerrainData(
+            x_min,
+            y_min,
+            x_max,
+            y_max,
+            resolution,
+            nbcols,
+            nbrows,
+            no_data,
+            p.DataFrame(grid, copy=False),
+        )
+
+
+def _read_slab_to_shared_memory(
+    file_path: str,
+    bbox: tuple[float, float, float, float] = None,
+    margin: float = 0,
+    render_resolution: float = None,
+) -> tuple[TerrainData, str]:
+    """
+    Parses a slab in a worker process, and writes its grid in a new shared memory block to avoid pickling it.
+    :param file_path: path of the .asc file
+    :param bbox: if provided, only the rows that crop keeps for this bounding box are parsed
+    :param margin: margin added around bbox, in m
+    :param render_resolution: resolution at which the terrain will be rendered, as used by crop
+    :return: the TerrainData of the slab without its data, and the name of the shared memory block holding the grid
+    """
+    terrain_data = ASCParser.read_slab(file_path, bbox, margin, render_resolution)
+    grid = terrain_data.data.values
+
+    # A band of rows can be empty, and shared memory blocks can't
+    shared_memory = SharedMemory(create=True, size=max(grid.nbytes, 1))
+    np.ndarray(grid.shape, dtype=grid.dtype, buffer=shared_memory.buf)[:] = grid
+    shared_memory.close()
+
+    # The block is freed by the main process once it has read it.
+    # Without this, the resource tracker of the worker would destroy it when the pool shuts down.
+    resource_tracker.unregister(shared_memory._name, "shared_memory")
+
+    return dataclasses.replace(terrain_data, data=None), shared_memory.name
+
+
+def _free_shared_memory(shared_memory_name: str):
+    """
+    Frees a shared memory block created by _read_slab_to_shared_memory without reading it
+    """
+    shared_memory = SharedMemory(name=shared_memory_name)
+    shared_memory.close()
+    shared_memory.unlink()
+
+
+def _terrain_data_from_shared_memory(
+    terrain_header: TerrainData, shared_memory_name: str
+) -> TerrainData:
+    """
+    Gets back a slab parsed by _read_slab_to_shared_memory, and frees the shared memory block
+    """
+    shared_memory = SharedMemory(name=shared_memory_name)
+    try:
+        grid = np.array(
+            np.ndarray(
+                (terrain_header.nbrow, terrain_header.nbcol),
+                dtype=np.float32,
+                buffer=shared_memory.buf,
+            )
+        )
+    finally:
+        shared_memory.close()
+        shared_memory.unlink()
 
-        return loaded_files
+    return dataclasses.replace(terrain_header, data=p.DataFrame(grid, copy=False))
@@ -2,6 +2,8 @@ import os
 
 import numpy as np
 import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import Affine
 from rasterio.windows import Window
 
 from mage_procgen.Utils.Utils import GeoWindow, CRS_fr
@@ -10,30 +12,47 @@ from mage_procgen.Parser.ShapeFileParser import ShapeFileParser
 
 # TODO: Maybe this should'nt be called Parser since it does more than that ?
 class JP2Parser:
+    _texture_block_size = 256
+    _texture_overview_factors = [2, 4, 8, 16]
+
     @staticmethod
     def create_texture_img(
         file_folder: str,
         geo_window: GeoWindow,
         slab_file: str,
         texture_file_path: str,
+        texture_resolution: float = None,
     ):
+        """
+        Creates the texture of a terrain mesh from the BDORTHO slabs
+        :param file_folder: folder containing the .jp2 files
+        :param geo_window: the window covered by the texture
+        :param slab_file: shapefile describing the slabs
+        :param texture_file_path: path of the texture file to write
+        :param texture_resolution: ground size of a pixel of the texture, in m. The slabs are downsampled to it when
+        read, using the overviews of the JP2 files. If None or finer than the slabs, the resolution of the slabs is used.
+        """
         bbox = geo_window.bounds
         slabs = ShapeFileParser.load(slab_file, bbox, CRS_fr)
         slab_parts = slabs.overlay(
             geo_window.dataframe, how="intersection", keep_geom_type=True
         )
 
-        img_parts = {}
-        img_bounds = {}
+        if slab_parts.empty:
+            raise ValueError("Error during slab stitching: cannot have 0 slabs")
+
+        img_parts = []
+        pixel_size = 0 if texture_resolution is None else texture_resolution
 
         for index, row in slab_parts.iterrows():
-            file_name = os.path.basename(row["NOM"])
+            file_path = os.path.join(file_folder, os.path.basename(row["NOM"]))
 
             row_bounds = row["geometry"].bounds
-            img_bounds[index] = row_bounds
 
-            with rasterio.open(os.path.join(file_folder, file_name)) as src:
+            with rasterio.open(file_path) as src:
                 invert_transform = src.profile["transform"].__invert__()
+                # The texture is never finer than the slabs
+                pixel_size = max(pixel_size, src.res[0])
 
             upper_left = (row_bounds[0], row_bounds[3])
             lower_right = (row_bounds[2], row_bounds[1])
@@ -49,90 +68,47 @@ class JP2Parser:
                 p_upper_left[0], p_upper_left[1], window_width, window_height
             )
 
+            img_parts.append((file_path, row_bounds, img_window))
+
+        # Each slab part is written directly at its place in the texture, whatever the number of parts
+        img_full = np.zeros(
+            (
+                3,
+                max(1, round((bbox[3] - bbox[1]) / pixel_size)),
+                max(1, round((bbox[2] - bbox[0]) / pixel_size)),
+            ),
+            dtype=rasterio.uint8,
+        )
+
+        for file_path, row_bounds, img_window in img_parts:
+            # Offsets are computed from the texture origin, so that adjacent parts share their edges exactly
+            col_start = round((row_bounds[0] - bbox[0]) / pixel_size)
+            col_end = round((row_bounds[2] - bbox[0]) / pixel_size)
+            row_start = round((bbox[3] - row_bounds[3]) / pixel_size)
+            row_end = round((bbox[3] - row_bounds[1]) / pixel_size)
+
+            if col_end <= col_start or row_end <= row_start:
+                continue
+
             # Need to use a 2nd "with" because read fails if it's not done right after the "open"
-            with rasterio.open(os.path.join(file_folder, file_name)) as src:
-                # TODO: evaluate downsampling: https://rasterio.readthedocs.io/en/stable/topics/resampling.html
-                img_data = src.read((1, 2, 3), window=img_window)
-
-            # Moving from channel first to channel last
-            img_data = np.moveaxis(img_data, 0, -1)
-
-            img_parts[index] = img_data
-
-        img_full = None
-
-        match len(img_parts):
-            case 0:
-                raise ValueError("Error during slab stitching: cannot have 0 slabs")
-            case 3:
-                # Should not ever get into a position where you have 3 slabs,
-                # because RGE of a region is strictly contained inside the BDORTHO
-                raise ValueError("Error during slab stitching: cannot have 3 slabs")
-            case 1:
-                # Nothing special to do
-                img_full = img_parts[0]
-            case 2:
-                if img_bounds[0][0] == img_bounds[1][0]:
-                    # If the xmin are the same, meaning if one image is on top of the other
-
-                    if img_bounds[0][1] < img_bounds[1][1]:
-                        top_part = img_parts[1]
-                        bottom_part = img_parts[0]
-                    else:
-                        top_part = img_parts[0]
-                        bottom_part = img_parts[1]
-
-                    img_full = np.concatenate((top_part, bottom_part), axis=0)
-                else:
-                    # In the other case, one is on the left of the other
-                    if img_bounds[0][0] < img_bounds[1][0]:
-                        left_part = img_parts[0]
-                        right_part = img_parts[1]
-                    else:
-                        left_part = img_parts[1]
-                        right_part = img_parts[0]
-                    img_full = np.concatenate((left_part, right_part), axis=1)
-            case 4:
-                # Image is split in 4 parts
-                bottom_left = None
-                bottom_right = None
-                top_left = None
-                top_right = None
-                for i in range(4):
-                    if img_bounds[i][0] == bbox[0]:
-                        # Left side
-                        if img_bounds[i][1] == bbox[1]:
-                            # Bottom part
-                            bottom_left = img_parts[i]
-                        else:
-                            # Top part
-                            top_left = img_parts[i]
-                    else:
-                        # Right side
-                        if img_bounds[i][1] == bbox[1]:
-                            # Bottom part
-                            bottom_right = img_parts[i]
-                        else:
-                            # Top part
-                            top_right = img_parts[i]
-
-                if bottom_left is None:
-                    raise ValueError("Bottom left not atributed")
-                if top_left is None:
-                    raise ValueError("top left not atributed")
-                if bottom_right is None:
-                    raise ValueError("Bottom right not atributed")
-                if top_right is None:
-                    raise ValueError("top right not atributed")
-
-                top_part = np.concatenate((top_left, top_right), axis=1)
-                bottom_part = np.concatenate((bottom_left, bottom_right), axis=1)
-                img_full = np.concatenate((top_part, bottom_part), axis=0)
-
-        # Switching back to channel first and changing type to be able to write the image
-        img_full = np.rollaxis(img_full, axis=2).astype(rasterio.uint8)
+            with rasterio.open(file_path) as src:
+                # When the window is read at a lower resolution, only the resolution level needed is decoded
+                src.read(
+                    (1, 2, 3),
+                    window=img_window,
+                    out=img_full[:, row_start:row_end, col_start:col_end],
+                    resampling=Resampling.average,
+                )
+
+        # Overviews smaller than a block are useless
+        overview_factors = [
+            x
+            for x in JP2Parser._texture_overview_factors
+            if max(img_full.shape[1:]) // x >= JP2Parser._texture_block_size
+        ]
 
         # TODO: currently YCBCR requires jpeg compression. Evaluate if there is a better way
+        # Tiled and with internal overviews, so that readers can load only the part and the level they need
         with rasterio.open(
             texture_file_path,
             "w",
@@ -141,7 +117,16 @@ class JP2Parser:
             height=img_full.shape[1],
             count=3,
             dtype=rasterio.uint8,
+            crs=CRS_fr,
+            transform=Affine(pixel_size, 0, bbox[0], 0, -pixel_size, bbox[3]),
+            tiled=True,
+            blockxsize=JP2Parser._texture_block_size,
+            blockysize=JP2Parser._texture_block_size,
             compress="JPEG",
             photometric="YCBCR",
         ) as dst:
             dst.write(img_full)
+
+            if overview_factors:
+                dst.build_overviews(overview_factors, Resampling.average)
+                dst.update_tags(ns="rio_overview", resampling="average")
@@ -1,21 +1,76 @@
+import os
+
 from mage_procgen.Parser.BaseParser import BaseParser
 from pyogrio import read_dataframe, read_info
+import numpy as np
+import pyarrow.parquet as pq
 import geopandas as g
 import shapely
 
 
 class ShapeFileParser:
+    _fields = "fields"
+    _parquet_extension = ".parquet"
+    _bbox_columns = ["bbox_xmin", "bbox_ymin", "bbox_xmax", "bbox_ymax"]
+    # Geometry column of the GeoParquet files written by ingest
+    _parquet_geometry = "geometry"
+    # Small row groups make the bounding box statistics of each group tighter, so more groups can be skipped
+    _parquet_row_group_size = 4096
+
     @staticmethod
     def load(
         file_path: str,
         bbox: tuple[float, float, float, float],
         to_crs: int,
         force_2d=False,
+        columns: list[str] = None,
     ) -> g.GeoDataFrame:
-        file_data = read_dataframe(file_path, bbox=bbox, force_2d=force_2d).to_crs(
-            to_crs
+        """
+        Loads the features of a shapefile intersecting a bounding box
+        :param file_path: the path of the shapefile
+        :param bbox: the bounding box to load, in the crs of the file
+        :param to_crs: the crs to convert the features to
+        :param force_2d: if True, z coordinates are dropped
+        :param columns: the attribute columns to decode. Columns missing from the file are ignored. If None, all
+        columns are decoded.
+        :return: the loaded features
+        """
+        parquet_path = ShapeFileParser.parquet_path(file_path)
+
+        if columns is not None:
+            columns = ShapeFileParser.available_columns(
+                ShapeFileParser.fields(file_path, parquet_path), columns
+            )
+
+        return ShapeFileParser._load_file(
+            file_path, parquet_path, bbox, to_crs, force_2d, columns
         )
 
+    @staticmethod
+    def _load_file(
+        file_path: str,
+        parquet_path: str | None,
+        bbox: tuple[float, float, float, float],
+        to_crs: int,
+        force_2d=False,
+        columns: list[str] = None,
+    ) -> g.GeoDataFrame:
+        """
+        Loads the features of a shapefile intersecting a bounding box, the columns being already checked against the
+        fields of the file
+        :param parquet_path: the GeoParquet version of the file, as returned by parquet_path
+        """
+        if parquet_path is not None:
+            file_data = ShapeFileParser._load_parquet(
+                parquet_path, bbox, force_2d, columns
+            )
+        else:
+            file_data = read_dataframe(
+                file_path, bbox=bbox, force_2d=force_2d, columns=columns
+            )
+
+        file_data = file_data.to_crs(to_crs)
+
         file_data.set_geometry(
             shapely.set_precision(file_data.geometry, 1e-2), inplace=True
         )
@@ -27,8 +82,11 @@ class ShapeFileParser:
         file_path: str,
         to_crs: int,
         force_2d=False,
+        columns: list[str] = None,
     ) -> g.GeoDataFrame:
-        file_data = read_dataframe(file_path, force_2d=force_2d).to_crs(to_crs)
+        file_data = read_dataframe(
+            file_path, force_2d=force_2d, columns=columns
+        ).to_crs(to_crs)
 
         file_data.set_geometry(
             shapely.set_precision(file_data.geometry, 1e-2), inplace=True
@@ -36,30 +94,175 @@ class ShapeFileParser:
 
         return file_data
 
+    @staticmethod
+    def available_columns(file_fields: list[str], columns: list[str]) -> list[str]:
+        """
+        Keeps the columns that are present in a shapefile, in the order of the file
+        :param file_fields: the attribute columns of the file, as returned by fields
+        :param columns: the columns to keep
+        """
+        return [i for i in file_fields if i in columns]
+
+    @staticmethod
+    def fields(file_path: str, parquet_path: str = None) -> list[str]:
+        """
+        Lists the attribute columns of a shapefile
+        :param file_path: the path of the shapefile
+        :param parquet_path: the GeoParquet version of the file, as returned by parquet_path. If provided, the columns
+        are read from its schema without opening the shapefile.
+        :return: the names of the attribute columns
+        """
+        if parquet_path is None:
+            return list(read_info(file_path)[ShapeFileParser._fields])
+
+        return [
+            i
+            for i in pq.read_schema(parquet_path).names
+            if i != ShapeFileParser._parquet_geometry
+            and i not in ShapeFileParser._bbox_columns
+        ]
+
+    @staticmethod
+    def parquet_path(file_path: str) -> str | None:
+        """
+        Finds the GeoParquet version of a shapefile created by ingest
+        :param file_path: the path of the shapefile
+        :return: the path of the GeoParquet file, or None if there is none or if it is older than the shapefile
+        """
+        parquet_path = (
+            os.path.splitext(file_path)[0] + ShapeFileParser._parquet_extension
+        )
+
+        if not os.path.isfile(parquet_path):
+            return None
+
+        if os.path.getmtime(parquet_path) < os.path.getmtime(file_path):
+            print("Ignoring outdated file " + parquet_path)
+            return None
+
+        return parquet_path
+
+    @staticmethod
+    def ingest(file_path: str, columns: list[str] = None):
+        """
+        Converts a shapefile to a GeoParquet file next to it, that will be used by load instead of the shapefile.
+        Features are sorted along a Hilbert curve so that close features are in the same row groups, and the bounding
+        box of every feature is stored in its own columns. The statistics of these columns allow whole row groups to be
+        skipped when reading a bounding box.
+        :param file_path: the path of the shapefile
+        :param columns: the columns to keep. If None, all columns are kept.
+        """
+        file_data = read_dataframe(file_path, columns=columns)
+
+        # Hilbert distances can't be computed for missing or empty geometries, so they are put last
+        valid = ~(file_data.geometry.isna() | file_data.geometry.is_empty).values
+        order = np.flatnonzero(valid)
+        if len(order) > 0:
+            order = order[
+                file_data.geometry[valid]
+                .hilbert_distance()
+                .values.argsort(kind="stable")
+            ]
+        file_data = file_data.iloc[np.concatenate([order, np.flatnonzero(~valid)])]
+
+        bounds = file_data.geometry.bounds
+        for column, bound in zip(ShapeFileParser._bbox_columns, bounds.columns):
+            file_data[column] = bounds[bound].values
+
+        parquet_path = (
+            os.path.splitext(file_path)[0] + ShapeFileParser._parquet_extension
+        )
+        tmp_path = parquet_path + ".tmp"
+
+        try:
+            file_data.reset_index(drop=True).to_parquet(
+                tmp_path, row_group_size=ShapeFileParser._parquet_row_group_size
+            )
+            os.replace(tmp_path, parquet_path)
+        finally:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+
+    @staticmethod
+    def _load_parquet(
+        parquet_path: str,
+        bbox: tuple[float, float, float, float],
+        force_2d=False,
+        columns: list[str] = None,
+    ) -> g.GeoDataFrame:
+        x_min, y_min, x_max, y_max = ShapeFileParser._bbox_columns
+
+        # Row groups and features whose bounding box does not intersect bbox are skipped while reading
+        bbox_filter = [
+            (x_min, "<=", bbox[2]),
+            (x_max, ">=", bbox[0]),
+            (y_min, "<=", bbox[3]),
+            (y_max, ">=", bbox[1]),
+        ]
+
+        if columns is not None:
+            columns = columns + [ShapeFileParser._parquet_geometry]
+
+        file_data = g.read_parquet(
+            parquet_path, columns=columns, filters=bbox_filter
+        ).drop(columns=ShapeFileParser._bbox_columns, errors="ignore")
+
+        # Like the bbox filter of pyogrio, only the features actually intersecting bbox are kept
+        bbox_geometry = shapely.box(*bbox)
+        shapely.prepare(bbox_geometry)
+        file_data = file_data[
+            shapely.intersects(bbox_geometry, file_data.geometry.values)
+        ].reset_index(drop=True)
+
+        if force_2d:
+            file_data.set_geometry(shapely.force_2d(file_data.geometry), inplace=True)
+
+        return file_data
+
 
 # Need this because of a bug (?) if we use pyogrio on roads (timestamp issue)
 class RoadShapeFileParser:
-    _fields = "fields"
     _invalid_columns = ["DATE_SERV", "DATE_CONF", "DATE_APP"]
 
     @staticmethod
     def load(
-        file_path: str, bbox: tuple[float, float, float, float], to_crs: int
+        file_path: str,
+        bbox: tuple[float, float, float, float],
+        to_crs: int,
+        columns: list[str] = None,
     ) -> g.GeoDataFrame:
-        file_info = read_info(file_path)
+        parquet_path = ShapeFileParser.parquet_path(file_path)
 
-        file_fields = file_info[RoadShapeFileParser._fields]
+        # Fields are listed once, both to remove the invalid columns and the ones missing from the file
+        return ShapeFileParser._load_file(
+            file_path,
+            parquet_path,
+            bbox,
+            to_crs,
+            force_2d=True,
+            columns=RoadShapeFileParser.valid_columns(
+                ShapeFileParser.fields(file_path, parquet_path), columns
+            ),
+        )
 
-        valid_columns = [
-            i for i in file_fields if i not in RoadShapeFileParser._invalid_columns
+    @staticmethod
+    def valid_columns(file_fields: list[str], columns: list[str] = None) -> list[str]:
+        """
+        Removes the invalid columns from the columns to decode
+        :param file_fields: the attribute columns of the file, as returned by ShapeFileParser.fields
+        :param columns: the columns to decode. If None, all the columns of the file are used.
+        :return: the valid columns present in the file
+        """
+        return [
+            i
+            for i in file_fields
+            if i not in RoadShapeFileParser._invalid_columns
+            and (columns is None or i in columns)
         ]
 
-        file_data = read_dataframe(
-            file_path, force_2d=True, columns=valid_columns, bbox=bbox
-        ).to_crs(to_crs)
-
-        file_data.set_geometry(
-            shapely.set_precision(file_data.geometry, 1e-2), inplace=True
+    @staticmethod
+    def ingest(file_path: str):
+        ShapeFileParser.ingest(
+            file_path,
+            RoadShapeFileParser.valid_columns(ShapeFileParser.fields(file_path)),
         )
-
-        return file_data
@@ -1,9 +1,28 @@
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
 import geopandas as g
-from mage_procgen.Utils.Utils import RenderingData, GeoWindow, CRS_fr
-from mage_procgen.Utils.Geometry import polygonise
+import numpy as np
+import shapely
+from mage_procgen.Utils.Utils import (
+    RenderingData,
+    GeoWindow,
+    PolygonList,
+    LineStringList,
+    CRS_fr,
+    process_start_method,
+)
+from mage_procgen.Utils.Geometry import polygonise_roads
 from shapely.geometry import MultiPolygon, Polygon, mapping
-from functools import reduce
-from mage_procgen.Utils.Config import Config, window_type_town
+from mage_procgen.Utils.Config import (
+    Config,
+    window_type_town,
+    building_type_church,
+    building_type_mall,
+    building_type_factory,
+    building_type_default,
+)
 from mage_procgen.Loader.Loader import Loader
 
 
@@ -11,6 +30,7 @@ class Preprocessor:
     _window_threshold = 1e-2
     _minimal_size = 20
     _building_inter_threshold = 1
+    _subtract_group_size = 32
 
     def __init__(
         self, geo_data: g.GeoDataFrame, geowindow: GeoWindow, config: Config, crs: int
@@ -23,22 +43,14 @@ class Preprocessor:
     def process(self) -> RenderingData:
 
         print("Processing")
-        new_buildings = self.geo_data.buildings.overlay(
-            self.window.dataframe, how="intersection", keep_geom_type=True
-        )
-        new_forests = self.geo_data.forests.overlay(
-            self.window.dataframe, how="intersection", keep_geom_type=True
-        )
-        new_water = self.geo_data.water.overlay(
-            self.window.dataframe, how="intersection", keep_geom_type=True
-        )
+        new_buildings = self.__clip_to_window(self.geo_data.buildings)
+        new_forests = self.__clip_to_window(self.geo_data.forests)
+        new_water = self.__clip_to_window(self.geo_data.water)
 
         new_oceans = None
 
         if self.geo_data.ocean is not None:
-            new_oceans = self.geo_data.ocean.overlay(
-                self.window.dataframe, how="intersection", keep_geom_type=True
-            )
+            new_oceans = self.__clip_to_window(self.geo_data.ocean)
             if not new_oceans.empty:
                 new_oceans = new_oceans.overlay(
                     self.geo_data.departements, how="difference", keep_geom_type=True
@@ -53,57 +65,26 @@ class Preprocessor:
         non_car_natures = ["Chemin", "Escalier", "Sentier"]
         roads_with_cars = new_roads.query("NATURE not in @non_car_natures")
         # Transform the Polylines into polygons to allow geometry operations with other dataframes
-        roads_elements = [
-            polygonise(
-                x[0],
-                x[1],
-                x[2],
-                x[3],
-                self.config.window_type == window_type_town,
-                self.window,
-            )
-            for x in roads_with_cars[["geometry", "LARGEUR", "NB_VOIES", "SENS"]]
-            .to_numpy()
-            .tolist()
-        ]
+        roads_elements = self.__polygonise_roads(roads_with_cars)
 
-        roads_content = {}
-        or_row_index = 0
-
-        for index, row in roads_with_cars.iterrows():
-            for geometry in roads_elements[or_row_index][0]:
-                new_row = row.to_dict()
-                new_row["geometry"] = geometry
-
-                for key, value in new_row.items():
-                    if key not in roads_content.keys():
-                        roads_content[key] = []
-                    roads_content[key].append(value)
-
-            or_row_index += 1
-
-        roads_polygonised = g.GeoDataFrame(roads_content, crs=CRS_fr)
-
-        roads_lanes = reduce(lambda x, y: x + y, [x[1] for x in roads_elements])
-
-        # Now that roads are polygons, we can apply the window on them and remove them from the background
-        roads_polygonised = roads_polygonised.overlay(
-            self.window.dataframe, how="intersection", keep_geom_type=True
+        # Each road is repeated once per polygon it was split into
+        roads_polygons_nbr = np.array([len(x[0]) for x in roads_elements], dtype=int)
+        roads_polygonised = roads_with_cars.iloc[
+            np.repeat(np.arange(len(roads_with_cars)), roads_polygons_nbr)
+        ].reset_index(drop=True)
+        roads_polygonised[roads_polygonised.geometry.name] = np.array(
+            list(itertools.chain.from_iterable(x[0] for x in roads_elements)),
+            dtype=object,
         )
 
-        # Removing roads from forests so we don't have trees on the road
-        new_forests = new_forests.overlay(
-            roads_with_cars, how="difference", keep_geom_type=True
-        )
+        roads_lanes = list(itertools.chain.from_iterable(x[1] for x in roads_elements))
 
-        # Forests can intersect buildings, which we don't want
-        cleaned_forests = new_forests.overlay(
-            new_buildings, how="difference", keep_geom_type=True
-        )
+        # Now that roads are polygons, we can apply the window on them and remove them from the background
+        roads_polygonised = self.__clip_to_window(roads_polygonised)
 
-        # Removing water from forests
-        cleaned_forests = cleaned_forests.overlay(
-            new_water, how="difference", keep_geom_type=True
+        # Removing roads, buildings and water from forests, so we don't have trees on them
+        cleaned_forests = self.__subtract(
+            new_forests, [roads_polygonised, new_buildings, new_water]
         )
 
         # Splitting water between "still" and "flowing"
@@ -112,15 +93,11 @@ class Preprocessor:
         flowing_water = new_water.query("NATURE in @flowing_water_tags")
         still_water = new_water.query("NATURE not in @flowing_water_tags")
 
-        churches_tags = ["Religieux"]
-        churches = new_buildings.query("USAGE1 in @churches_tags")
-        non_churches = new_buildings.query("USAGE1 not in @churches_tags")
-        malls_tags = ["Commercial et services"]
-        malls = non_churches.query("USAGE1 in @malls_tags")
-        non_malls = non_churches.query("USAGE1 not in @malls_tags")
-        factories_tags = ["Industriel"]
-        factories = non_malls.query("USAGE1 in @factories_tags")
-        default_buildings = non_malls.query("USAGE1 not in @factories_tags")
+        buildings_by_type = self.__classify_buildings(new_buildings)
+        churches = buildings_by_type[building_type_church]
+        malls = buildings_by_type[building_type_mall]
+        factories = buildings_by_type[building_type_factory]
+        default_buildings = buildings_by_type[building_type_default]
 
         rendering_data = RenderingData(
             cleaned_forests,
@@ -136,3 +113,220 @@ class Preprocessor:
         )
 
         return rendering_data
+
+    def __polygonise_roads(
+        self, roads: g.GeoDataFrame
+    ) -> list[tuple[PolygonList, LineStringList]]:
+        """
+        Polygonises the roads, splitting them in chunks processed in parallel if there are enough of them
+        :param roads: the roads to polygonise
+        :return: the polygons and the lanes of each road, in the order of the roads
+        """
+        restrict_to_town = self.config.window_type == window_type_town
+
+        roads_geometries = np.asarray(roads.geometry.values, dtype=object)
+        roads_thicknesses = roads["LARGEUR"].to_numpy(dtype=float)
+        roads_lanes_nbr = roads["NB_VOIES"].to_numpy(dtype=float)
+        roads_directions = roads["SENS"].tolist()
+
+        chunk_size = max(1, self.config.road_chunk_size)
+
+        if self.config.road_preprocess_workers <= 1 or len(roads) <= chunk_size:
+            return polygonise_roads(
+                roads_geometries,
+                roads_thicknesses,
+                roads_lanes_nbr,
+                roads_directions,
+                restrict_to_town,
+                self.window,
+            )
+
+        chunks = [slice(x, x + chunk_size) for x in range(0, len(roads), chunk_size)]
+
+        with ProcessPoolExecutor(
+            max_workers=min(self.config.road_preprocess_workers, len(chunks)),
+            mp_context=multiprocessing.get_context(process_start_method),
+        ) as executor:
+            # map returns the results in the order of the chunks
+            chunks_elements = executor.map(
+                polygonise_roads,
+                [roads_geometries[x] for x in chunks],
+                [roads_thicknesses[x] for x in chunks],
+                [roads_lanes_nbr[x] for x in chunks],
+                [roads_directions[x] for x in chunks],
+                itertools.repeat(restrict_to_town),
+                itertools.repeat(self.window),
+            )
+
+            return list(itertools.chain.from_iterable(chunks_elements))
+
+    def __classify_buildings(
+        self, buildings: g.GeoDataFrame
+    ) -> dict[str, g.GeoDataFrame]:
+        """
+        Splits the buildings by type, according to the type of their USAGE1 tag in the config
+        :param buildings: the buildings to split
+        :return: for each building type, its buildings in their original order
+        """
+        building_types = [
+            building_type_church,
+            building_type_mall,
+            building_type_factory,
+            building_type_default,
+        ]
+        default_code = building_types.index(building_type_default)
+
+        usages_codes = {
+            usage: building_types.index(building_type)
+            for usage, building_type in self.config.building_usages.items()
+            if building_type in building_types
+        }
+
+        # Tags that are not in the config are default buildings
+        buildings_codes = (
+            buildings["USAGE1"]
+            .map(usages_codes)
+            .fillna(default_code)
+            .to_numpy(dtype=int)
+        )
+
+        # A single sort groups the buildings by type, each type being then a slice of the sorted buildings
+        sorted_buildings = buildings.iloc[np.argsort(buildings_codes, kind="stable")]
+        types_limits = np.searchsorted(
+            np.sort(buildings_codes), np.arange(len(building_types) + 1)
+        )
+
+        return {
+            building_type: sorted_buildings.iloc[
+                types_limits[code] : types_limits[code + 1]
+            ]
+            for code, building_type in enumerate(building_types)
+        }
+
+    def __subtract(
+        self, data: g.GeoDataFrame, subtracted: list[g.GeoDataFrame]
+    ) -> g.GeoDataFrame:
+        """
+        Removes polygons from features, like successive overlay differences would.
+        Only the features hit by a polygon are cut, and the polygons hitting a feature are merged by groups before
+        being subtracted, which is much cheaper than subtracting them one at a time.
+        :param data: the features to cut
+        :param subtracted: the dataframes of the polygons to remove from the features
+        :return: the polygonal parts of the features that remain
+        """
+        geometries = Preprocessor.__valid_polygons(np.asarray(data.geometry.values))
+        subtracted_geometries = Preprocessor.__valid_polygons(
+            np.concatenate([np.asarray(x.geometry.values) for x in subtracted])
+        )
+
+        tree = shapely.STRtree(subtracted_geometries)
+        data_indexes, subtracted_indexes = tree.query(
+            geometries, predicate="intersects"
+        )
+
+        # Polygons are subtracted in the order of the dataframes, like the overlays would
+        order = np.lexsort((subtracted_indexes, data_indexes))
+        hit_indexes, hit_starts = np.unique(data_indexes[order], return_index=True)
+
+        for data_index, neighbours in zip(
+            hit_indexes, np.split(subtracted_indexes[order], hit_starts[1:])
+        ):
+            geometry = geometries[data_index]
+
+            # Merging too many overlapping polygons at once gets expensive, so they are merged by small groups.
+            # This also allows to stop as soon as nothing is left of the feature
+            for start in range(0, len(neighbours), Preprocessor._subtract_group_size):
+                group = neighbours[start : start + Preprocessor._subtract_group_size]
+                geometry = geometry.difference(
+                    shapely.union_all(subtracted_geometries[group])
+                )
+                if geometry.is_empty:
+                    break
+
+            geometries[data_index] = Preprocessor.__polygonal_part(geometry)
+
+        result = data.reset_index(drop=True)
+        result[result.geometry.name] = geometries
+
+        return result[~result.geometry.is_empty].reset_index(drop=True)
+
+    @staticmethod
+    def __valid_polygons(geometries: np.ndarray) -> np.ndarray:
+        """
+        Repairs the invalid geometries of an array, keeping their polygonal parts like overlay does
+        """
+        geometries = geometries.copy()
+        invalid = ~shapely.is_valid(geometries)
+        geometries[invalid] = [
+            Preprocessor.__polygonal_part(x)
+            for x in shapely.make_valid(geometries[invalid])
+        ]
+
+        return geometries
+
+    def __clip_to_window(self, data: g.GeoDataFrame) -> g.GeoDataFrame:
+        """
+        Keeps the polygonal parts of the features inside the window, like an overlay intersection with it.
+        For rectangle windows, features are selected with the spatial index, and only those crossing the border of
+        the window are clipped.
+        """
+        if not self.window.is_rectangle:
+            return data.overlay(
+                self.window.dataframe, how="intersection", keep_geom_type=True
+            )
+
+        window_geometry = self.window.dataframe.geometry[0]
+
+        selected_indexes = np.sort(
+            data.sindex.query(window_geometry, predicate="intersects")
+        )
+        selected = data.iloc[selected_indexes].reset_index(drop=True)
+
+        # Clipping invalid geometries gives wrong results, overlay repairs them too
+        geometries = Preprocessor.__valid_polygons(np.asarray(selected.geometry.values))
+
+        # With a rectangle window, a feature whose bounding box is inside the window is inside the window
+        bounds = shapely.bounds(geometries)
+        crossing = (
+            (bounds[:, 0] < self.window.bounds[0])
+            | (bounds[:, 1] < self.window.bounds[1])
+            | (bounds[:, 2] > self.window.bounds[2])
+            | (bounds[:, 3] > self.window.bounds[3])
+        )
+
+        geometries[crossing] = [
+            Preprocessor.__polygonal_part(x)
+            for x in shapely.clip_by_rect(geometries[crossing], *self.window.bounds)
+        ]
+
+        selected[selected.geometry.name] = geometries
+
+        # Same columns as the overlay: the attributes of the window are added, and the geometry is last
+        for column in self.window.dataframe.columns:
+            if column != self.window.dataframe.geometry.name:
+                selected[column] = self.window.dataframe[column].iloc[0]
+        selected = selected[
+            [x for x in selected.columns if x != selected.geometry.name]
+            + [selected.geometry.name]
+        ]
+
+        # Features that only touch the window
+        return selected[~selected.geometry.is_empty].reset_index(drop=True)
+
+    @staticmethod
+    def __polygonal_part(geometry):
+        match geometry.geom_type:
+            case "Polygon" | "MultiPolygon":
+                return geometry
+            case "GeometryCollection":
+                polygons = [
+                    y
+                    for x in shapely.get_parts(geometry)
+                    for y in shapely.get_parts(x)
+                    if y.geom_type == "Polygon" and not y.is_empty
+                ]
+                if len(polygons) == 1:
+                    return polygons[0]
+                return MultiPolygon(polygons)
+            case _:
+                return Polygon()
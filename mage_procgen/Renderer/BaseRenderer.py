@@ -1,19 +1,19 @@
 import os
 import bpy
 from bpy import data as D
-import bmesh
-from shapely.geometry import mapping
 from tqdm import tqdm
-import math
-from collections import deque
-from mage_procgen.Utils.Utils import PolygonList, Point, TerrainData
+import numpy as np
+from scipy.spatial import cKDTree
+from mage_procgen.Utils.Utils import PolygonList, Point, TerrainMosaic
+from mage_procgen.Utils.Geometry import polygons_rings_3d
+from mage_procgen.Renderer.MeshBuilder import MeshBuilder
 
 
 class BaseRenderer:
     _AssetsFolder = "Assets"
     _mesh_name = ""
 
-    def __init__(self, terrain_data: list[TerrainData], object_config):
+    def __init__(self, terrain_data: TerrainMosaic, object_config):
         self.config = object_config
         _location = os.path.realpath(
             os.path.join(os.getcwd(), os.path.dirname(__file__))
@@ -48,37 +48,18 @@ class BaseRenderer:
         geo_center: tuple[float, float, float],
         parent_collection_name,
     ):
-        mesh = bmesh.new()
+        mesh_builder = MeshBuilder()
 
-        for polygon in tqdm(polygons):
-            # Kind of hack because Polygon.coords is not implemented
-            polygon_geometry = mapping(polygon)["coordinates"]
-            points_coords = [
-                (x[0], x[1], self.interpolate_z(x[0], x[1]))
-                for x in polygon_geometry[0]
-            ]
-
-            if len(polygon_geometry) > 1:
-                # If there are holes
-                for hole in polygon_geometry[1:]:
-                    points_coords_hole = [
-                        (x[0], x[1], self.interpolate_z(x[0], x[1])) for x in hole
-                    ]
-
-                    points_coords = self.insert_hole(points_coords, points_coords_hole)
+        for polygon_rings in tqdm(polygons_rings_3d(polygons, self._terrain_data)):
+            points_coords = self.insert_holes(polygon_rings[0], polygon_rings[1:])
 
             # Adapting the coordinates for rendering purposes
             centered_points_coords = self.adapt_coords(points_coords, geo_center)
 
             # Need to remove the last point so that it's not repeated and creates a segment of 0 length
-            face = mesh.faces.new(
-                mesh.verts.new(x) for x in centered_points_coords[:-1]
-            )
+            mesh_builder.add_polygon(centered_points_coords[:-1])
 
-        mesh_name = self._mesh_name
-        mesh_data = D.meshes.new(mesh_name)
-        mesh.to_mesh(mesh_data)
-        mesh.free()
+        mesh_data = mesh_builder.to_mesh(self._mesh_name)
         mesh_obj = D.objects.new(mesh_data.name, mesh_data)
         mesh_obj.pass_index = self.config.tagging_index
         D.collections[parent_collection_name].objects.link(mesh_obj)
@@ -86,124 +67,42 @@ class BaseRenderer:
         m = mesh_obj.modifiers.new("", "NODES")
         m.node_group = D.node_groups[self.geometry_node_name]
 
-    def insert_hole(
-        self, points_coords: list[Point], points_coords_hole: list[Point]
+    def insert_holes(
+        self, points_coords: list[Point], holes_points_coords: list[list[Point]]
     ) -> list[Point]:
-        min_dist = math.inf
-        closest_pt_poly = None
-        closest_pt_hole = None
-
-        # Last point is always repeated to close the polygon/hole
-        unique_points_coords = points_coords[:-1]
-        unique_points_coords_hole = points_coords_hole[:-1]
-
-        # Finding the closest distance between the poly and the hole, and associated points
-        for pt_poly in unique_points_coords:
-            for pt_hole in unique_points_coords_hole:
-                distance = math.dist(pt_poly, pt_hole)
-                if distance < min_dist:
-                    min_dist = distance
-                    closest_pt_poly = pt_poly
-                    closest_pt_hole = pt_hole
-
-        # Making the closest point of the hole the first in the list
-        rotation_index = -unique_points_coords_hole.index(closest_pt_hole)
-        deq = deque(unique_points_coords_hole)
-        deq.rotate(rotation_index)
-        rotated_hole = list(deq)
-
-        # Splitting the orignal polygon at the correct index
-        insertion_index = unique_points_coords.index(closest_pt_poly) + 1
-        poly_first_part = unique_points_coords[:insertion_index]
-        poly_second_part = unique_points_coords[insertion_index:]
-
-        # Fusing the polygon with the hole
-        toreturn = []
-        toreturn.extend(poly_first_part)
-        toreturn.extend(rotated_hole)
-        toreturn.append(closest_pt_hole)
-        toreturn.append(closest_pt_poly)
-        toreturn.extend(poly_second_part)
-        toreturn.append(poly_first_part[0])
-
-        return toreturn
-
-    def interpolate_z(self, x, y):
         """
-        Finds the z coordinate corresponding to the (x,y) point in the input using bilinear interpolation
-        :param x: the x coordinate of the point
-        :param y: the y coordinate of the point
-        :return: the corresponding z coordinate of the point
+        Bridges the holes of a polygon to its outline, so that the polygon can be made of a single face.
+        Each hole, in order, is linked by the closest pair of points to the outline built so far.
+        :param points_coords: the points of the polygon, the first one being repeated at the end
+        :param holes_points_coords: the points of each hole, the first one being repeated at the end
+        :return: the points of the outline going around the holes, the first one being repeated at the end
         """
+        # Last point is always repeated to close the polygon/hole
+        outline = points_coords[:-1]
+
+        for hole_points_coords in holes_points_coords:
+            hole = hole_points_coords[:-1]
+
+            # Closest point of the hole to every point of the outline. The first of the closest pairs is used
+            distances, hole_indexes = cKDTree(hole).query(outline)
+            insertion_index = int(np.argmin(distances))
+            hole_index = int(hole_indexes[insertion_index])
+
+            closest_pt_poly = outline[insertion_index]
+            closest_pt_hole = hole[hole_index]
+
+            # Making the closest point of the hole the first in the list
+            rotated_hole = hole[hole_index:] + hole[:hole_index]
+
+            # Fusing the outline with the hole, right after the closest point of the outline
+            outline = (
+                outline[: insertion_index + 1]
+                + rotated_hole
+                + [closest_pt_hole, closest_pt_poly]
+                + outline[insertion_index + 1 :]
+            )
 
-        current_terrain = None
-
-        for terrain in self._terrain_data:
-            is_point_in_terrain = True
-            is_point_in_terrain &= x >= terrain.x_min
-            is_point_in_terrain &= x < terrain.x_max
-            is_point_in_terrain &= y >= terrain.y_min
-            is_point_in_terrain &= y < terrain.y_max
-
-            if is_point_in_terrain:
-                current_terrain = terrain
-                break
-
-        if current_terrain is None:
-            # Should never happen
-            return 0
-            # raise ValueError(
-            #    "Point is outside of terrain: x=" + str(x) + ", y=" + str(y)
-            # )
-
-        point_offset_x = x - current_terrain.x_min
-        point_offset_y = y - current_terrain.y_min
-
-        # Index of the point in the grid to the lower left of the current point
-        ll_index_x = int(point_offset_x / current_terrain.resolution)
-        ll_index_y = 999 - int(point_offset_y / current_terrain.resolution)
-
-        in_cell_offset_x = point_offset_x % current_terrain.resolution
-        in_cell_offset_y = point_offset_y % current_terrain.resolution
-
-        if ll_index_x == 999:
-            # If x index is at max, we cannt use the point to its right for interpolation
-            if ll_index_y == 999:
-                # If y index is at max, we cannt use the point above for interpolation
-                z_ll = current_terrain.data.values[ll_index_y][ll_index_x]
-
-                return z_ll
-            else:
-                z_ll = current_terrain.data.values[ll_index_y][ll_index_x]
-                z_ul = current_terrain.data.values[ll_index_y + 1][ll_index_x]
-
-                return (
-                    in_cell_offset_y * z_ul + (1 - in_cell_offset_y) * z_ll
-                ) / current_terrain.resolution
-        elif ll_index_y == 999:
-            # If y index is at max, we cannt use the point above for interpolation
-            z_ll = current_terrain.data.values[ll_index_y][ll_index_x]
-            z_lr = current_terrain.data.values[ll_index_y][ll_index_x + 1]
-
-            return (
-                in_cell_offset_x * z_lr + (1 - in_cell_offset_x) * z_ll
-            ) / current_terrain.resolution
-        else:
-            z_ll = current_terrain.data.values[ll_index_y][ll_index_x]
-            z_ul = current_terrain.data.values[ll_index_y + 1][ll_index_x]
-            z_ur = current_terrain.data.values[ll_index_y + 1][ll_index_x + 1]
-            z_lr = current_terrain.data.values[ll_index_y][ll_index_x + 1]
-
-            z_l = (
-                in_cell_offset_x * z_lr + (1 - in_cell_offset_x) * z_ll
-            ) / current_terrain.resolution
-            z_u = (
-                in_cell_offset_x * z_ur + (1 - in_cell_offset_x) * z_ul
-            ) / current_terrain.resolution
-
-            return (
-                in_cell_offset_y * z_u + (1 - in_cell_offset_y) * z_l
-            ) / current_terrain.resolution
+        return outline + [outline[0]]
 
     def adapt_coords(
         self, points_coords: list[Point], geo_center: Point
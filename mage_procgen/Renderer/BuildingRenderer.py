@@ -3,9 +3,9 @@ import math
 from mage_procgen.Renderer.BaseRenderer import BaseRenderer
 from bpy import data as D
 import bmesh
-from shapely.geometry import mapping
 from tqdm import tqdm
-from mage_procgen.Utils.Utils import BuildingList, Point, TerrainData
+from mage_procgen.Utils.Utils import BuildingList, Point, TerrainMosaic
+from mage_procgen.Utils.Geometry import polygons_rings_3d
 import os
 import bpy
 
@@ -13,7 +13,7 @@ import bpy
 class BuildingRenderer(BaseRenderer):
     _mesh_name = "Buildings"
 
-    def __init__(self, terrain_data: list[TerrainData], object_config):
+    def __init__(self, terrain_data: TerrainMosaic, object_config):
         self.config = object_config
         _location = os.path.realpath(
             os.path.join(os.getcwd(), os.path.dirname(__file__))
@@ -65,23 +65,15 @@ class BuildingRenderer(BaseRenderer):
 
         self._mesh_names = []
 
-        for building in tqdm(buildings):
+        buildings_rings = polygons_rings_3d(
+            [x[1] for x in buildings], self._terrain_data
+        )
+
+        for building, building_rings in tqdm(
+            zip(buildings, buildings_rings), total=len(buildings)
+        ):
             mesh = bmesh.new()
-            # Kind of hack because Polygon.coords is not implemented
-            polygon_geometry = mapping(building[1])["coordinates"]
-            points_coords = [
-                (x[0], x[1], self.interpolate_z(x[0], x[1]))
-                for x in polygon_geometry[0]
-            ]
-
-            if len(polygon_geometry) > 1:
-                # If there are holes
-                for hole in polygon_geometry[1:]:
-                    points_coords_hole = [
-                        (x[0], x[1], self.interpolate_z(x[0], x[1])) for x in hole
-                    ]
-
-                    points_coords = self.insert_hole(points_coords, points_coords_hole)
+            points_coords = self.insert_holes(building_rings[0], building_rings[1:])
 
             # Adapting the coordinates for rendering purposes
             centered_points_coords = self.adapt_coords(points_coords, geo_center)
@@ -1,13 +1,13 @@
 from bpy import data as D
 
 from mage_procgen.Renderer.BaseRenderer import BaseRenderer
-from mage_procgen.Utils.Utils import TerrainData
+from mage_procgen.Utils.Utils import TerrainMosaic
 
 
 class ForestRenderer(BaseRenderer):
     _mesh_name = "Forest"
 
-    def __init__(self, terrain_data: list[TerrainData], object_config):
+    def __init__(self, terrain_data: TerrainMosaic, object_config):
         super().__init__(terrain_data, object_config)
 
         # Need to bind the forest geometry node to the terrain collection so that trees are neither floating nor underground
@@ -0,0 +1,56 @@
+import bpy
+from bpy import data as D
+import numpy as np
+from mage_procgen.Utils.Utils import Point
+
+
+class MeshBuilder:
+    """
+    Builds a mesh made of separate polygons. The polygons are accumulated as flat arrays, and the mesh is then created
+    with a few bulk calls instead of creating its vertices and faces one at a time.
+    """
+
+    def __init__(self):
+        self._points = []
+        self._polygons_sizes = []
+
+    def add_polygon(self, points: list[Point]):
+        """
+        Adds a polygon to the mesh. Its points are not shared with the other polygons.
+        :param points: the points of the polygon, the first one not being repeated at the end
+        """
+        self._points.extend(points)
+        self._polygons_sizes.append(len(points))
+
+    def to_mesh(self, mesh_name: str):
+        """
+        Creates the mesh of the polygons added so far
+        :param mesh_name: the name of the mesh
+        :return: the mesh
+        """
+        vertices = np.asarray(self._points, dtype=np.float32).reshape(-1, 3)
+        polygons_sizes = np.asarray(self._polygons_sizes, dtype=np.int32)
+
+        loops_starts = np.zeros(len(polygons_sizes), dtype=np.int32)
+        loops_starts[1:] = np.cumsum(polygons_sizes)[:-1]
+
+        mesh_data = D.meshes.new(mesh_name)
+
+        mesh_data.vertices.add(len(vertices))
+        mesh_data.vertices.foreach_set("co", vertices.ravel())
+
+        # Each vertex is used by a single loop
+        mesh_data.loops.add(len(vertices))
+        mesh_data.loops.foreach_set(
+            "vertex_index", np.arange(len(vertices), dtype=np.int32)
+        )
+
+        mesh_data.polygons.add(len(polygons_sizes))
+        mesh_data.polygons.foreach_set("loop_start", loops_starts)
+        if bpy.app.version < (4, 0, 0):
+            # Starting with Blender 4.0, the sizes of the polygons are deduced from their starts
+            mesh_data.polygons.foreach_set("loop_total", polygons_sizes)
+
+        mesh_data.update(calc_edges=True)
+
+        return mesh_data
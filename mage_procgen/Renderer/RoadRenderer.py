@@ -2,11 +2,12 @@ import os
 import bpy
 from bpy import data as D
 import bmesh
-from shapely.geometry import mapping
+import numpy as np
 from tqdm import tqdm
-from mage_procgen.Utils.Utils import PolygonList, Point, TerrainData, LineStringList
-from mage_procgen.Utils.Geometry import norm2d
+from mage_procgen.Utils.Utils import PolygonList, Point, TerrainMosaic, LineStringList
+from mage_procgen.Utils.Geometry import norm2d, polygons_rings_3d
 from mage_procgen.Utils.Rendering import terrain_collection_name
+from mage_procgen.Renderer.MeshBuilder import MeshBuilder
 from random import random
 
 # TODO: find common paths with BaseRenderer
@@ -15,9 +16,7 @@ class RoadRenderer:
     _mesh_name = "Roads"
     _car_mesh_name = "Cars"
 
-    def __init__(
-        self, terrain_data: list[TerrainData], object_config, car_object_config
-    ):
+    def __init__(self, terrain_data: TerrainMosaic, object_config, car_object_config):
         self.config = object_config
         self.car_config = car_object_config
         _location = os.path.realpath(
@@ -75,28 +74,19 @@ class RoadRenderer:
         lanes: LineStringList,
         car_collection_name: str,
     ):
-        mesh = bmesh.new()
+        mesh_builder = MeshBuilder()
 
-        for polygon in tqdm(polygons):
-            # Kind of hack because Polygon.coords is not implemented
-            polygon_geometry = mapping(polygon)["coordinates"]
-            points_coords = [
-                (x[0], x[1], self.interpolate_z(x[0], x[1]))
-                for x in polygon_geometry[0]
-            ]
+        for polygon_rings in tqdm(polygons_rings_3d(polygons, self._terrain_data)):
+            # Holes of roads are not rendered
+            points_coords = polygon_rings[0]
 
             # Adapting the coordinates for rendering purposes
             centered_points_coords = self.adapt_coords(points_coords, geo_center)
 
             # Need to remove the last point so that it's not repeated and creates a segment of 0 length
-            face = mesh.faces.new(
-                mesh.verts.new(x) for x in centered_points_coords[:-1]
-            )
+            mesh_builder.add_polygon(centered_points_coords[:-1])
 
-        mesh_name = self._mesh_name
-        mesh_data = D.meshes.new(mesh_name)
-        mesh.to_mesh(mesh_data)
-        mesh.free()
+        mesh_data = mesh_builder.to_mesh(self._mesh_name)
         mesh_obj = D.objects.new(mesh_data.name, mesh_data)
         mesh_obj.pass_index = self.config.tagging_index
         D.collections[parent_collection_name].objects.link(mesh_obj)
@@ -121,6 +111,9 @@ class RoadRenderer:
         car_mesh = bmesh.new()
         next_car_distance = self.next_car_distance()
 
+        # Both points of each car, along which the car model is aligned
+        cars_points = []
+
         for lane in tqdm(lanes):
 
             previous_point = None
@@ -163,19 +156,7 @@ class RoadRenderer:
                             / current_lane_vector_norm,
                         )
 
-                        points_coords = [
-                            (x[0], x[1], self.interpolate_z(x[0], x[1]))
-                            for x in [car_point, car_point_2]
-                        ]
-
-                        # Adapting the coordinates for rendering purposes
-                        centered_points_coords = self.adapt_coords(
-                            points_coords, geo_center
-                        )
-
-                        edge = car_mesh.edges.new(
-                            car_mesh.verts.new(x) for x in centered_points_coords
-                        )
+                        cars_points.extend([car_point, car_point_2])
 
                         # Advancing
                         next_car_distance = self.next_car_distance()
@@ -191,6 +172,21 @@ class RoadRenderer:
 
                 previous_point = point
 
+        # Heights of all the cars are found at once, once they are all placed
+        cars_points_coords = np.column_stack(
+            [cars_points, self._terrain_data.sample(cars_points)]
+        ).tolist()
+
+        for car_index in range(0, len(cars_points_coords), 2):
+            # Adapting the coordinates for rendering purposes
+            centered_points_coords = self.adapt_coords(
+                cars_points_coords[car_index : car_index + 2], geo_center
+            )
+
+            edge = car_mesh.edges.new(
+                car_mesh.verts.new(x) for x in centered_points_coords
+            )
+
         car_mesh_name = self._car_mesh_name
         car_mesh_data = D.meshes.new(car_mesh_name)
         car_mesh.to_mesh(car_mesh_data)
@@ -202,83 +198,6 @@ class RoadRenderer:
         m = car_mesh_obj.modifiers.new("", "NODES")
         m.node_group = D.node_groups[self.car_geometry_node_name]
 
-    def interpolate_z(self, x, y):
-        """
-        Finds the z coordinate corresponding to the (x,y) point in the input using bilinear interpolation
-        :param x: the x coordinate of the point
-        :param y: the y coordinate of the point
-        :return: the corresponding z coordinate of the point
-        """
-
-        current_terrain = None
-
-        for terrain in self._terrain_data:
-            is_point_in_terrain = True
-            is_point_in_terrain &= x >= terrain.x_min
-            is_point_in_terrain &= x < terrain.x_max
-            is_point_in_terrain &= y >= terrain.y_min
-            is_point_in_terrain &= y < terrain.y_max
-
-            if is_point_in_terrain:
-                current_terrain = terrain
-                break
-
-        if current_terrain is None:
-            # Should never happen
-            return 0
-            # raise ValueError(
-            #    "Point is outside of terrain: x=" + str(x) + ", y=" + str(y)
-            # )
-
-        point_offset_x = x - current_terrain.x_min
-        point_offset_y = y - current_terrain.y_min
-
-        # Index of the point in the grid to the lower left of the current point
-        ll_index_x = int(point_offset_x / current_terrain.resolution)
-        ll_index_y = 999 - int(point_offset_y / current_terrain.resolution)
-
-        in_cell_offset_x = point_offset_x % current_terrain.resolution
-        in_cell_offset_y = point_offset_y % current_terrain.resolution
-
-        if ll_index_x == 999:
-            # If x index is at max, we cannt use the point to its right for interpolation
-            if ll_index_y == 999:
-                # If y index is at max, we cannt use the point above for interpolation
-                z_ll = current_terrain.data.values[ll_index_y][ll_index_x]
-
-                return z_ll
-            else:
-                z_ll = current_terrain.data.values[ll_index_y][ll_index_x]
-                z_ul = current_terrain.data.values[ll_index_y + 1][ll_index_x]
-
-                return (
-                    in_cell_offset_y * z_ul + (1 - in_cell_offset_y) * z_ll
-                ) / current_terrain.resolution
-        elif ll_index_y == 999:
-            # If y index is at max, we cannt use the point above for interpolation
-            z_ll = current_terrain.data.values[ll_index_y][ll_index_x]
-            z_lr = current_terrain.data.values[ll_index_y][ll_index_x + 1]
-
-            return (
-                in_cell_offset_x * z_lr + (1 - in_cell_offset_x) * z_ll
-            ) / current_terrain.resolution
-        else:
-            z_ll = current_terrain.data.values[ll_index_y][ll_index_x]
-            z_ul = current_terrain.data.values[ll_index_y + 1][ll_index_x]
-            z_ur = current_terrain.data.values[ll_index_y + 1][ll_index_x + 1]
-            z_lr = current_terrain.data.values[ll_index_y][ll_index_x + 1]
-
-            z_l = (
-                in_cell_offset_x * z_lr + (1 - in_cell_offset_x) * z_ll
-            ) / current_terrain.resolution
-            z_u = (
-                in_cell_offset_x * z_ur + (1 - in_cell_offset_x) * z_ul
-            ) / current_terrain.resolution
-
-            return (
-                in_cell_offset_y * z_u + (1 - in_cell_offset_y) * z_l
-            ) / current_terrain.resolution
-
     def adapt_coords(
         self, points_coords: list[Point], geo_center: Point
     ) -> list[Point]:
@@ -4,9 +4,13 @@ from bpy import data as D, context as C, ops as O
 import bmesh
 
 import math
+from concurrent.futures import ThreadPoolExecutor
 
-from mage_procgen.Utils.Utils import GeoWindow
+import numpy as np
+
+from mage_procgen.Utils.Utils import GeoWindow, TerrainMosaic
 from mage_procgen.Utils.Geometry import center_point
+from mage_procgen.Utils.Cache import TextureCache
 from mage_procgen.Loader import Loader
 
 
@@ -19,12 +23,21 @@ class TerrainRenderer:
     _AssetsFolder = "Assets"
 
     def __init__(
-        self, base_folder: str, render_resolution: float, file_resolution: float
+        self,
+        base_folder: str,
+        render_resolution: float,
+        file_resolution: float,
+        texture_cache: TextureCache,
+        texture_resolution: float = None,
+        texture_workers: int = 1,
     ):
 
         self.base_folder = base_folder
         self.render_resolution = render_resolution
         self.file_resolution = file_resolution
+        self.texture_cache = texture_cache
+        self.texture_resolution = texture_resolution
+        self.texture_workers = texture_workers
 
         if render_resolution / file_resolution != render_resolution // file_resolution:
             raise ValueError(
@@ -49,7 +62,7 @@ class TerrainRenderer:
 
     def render(
         self,
-        terrain_data,
+        terrain_data: TerrainMosaic,
         geo_window: GeoWindow,
         parent_collection_name,
         use_sat_img: bool = False,
@@ -61,223 +74,227 @@ class TerrainRenderer:
 
         box = geo_window.bounds
 
-        current_terrain = terrain_data[0]
-        terrain_index = 0
         previous_point_terrain_index = 0
 
-        meshes = {x: TerrainMeshInfo(bmesh.new()) for x in range(len(terrain_data))}
-        meshes_points = {x: {} for x in range(len(terrain_data))}
+        meshes = {
+            x: TerrainMeshInfo(bmesh.new()) for x in range(len(terrain_data.slab_boxes))
+        }
+        meshes_points = {x: {} for x in range(len(terrain_data.slab_boxes))}
 
-        global_x_min = min([x.x_min for x in terrain_data])
-        global_x_max = max([x.x_max for x in terrain_data])
-        global_y_min = min([x.y_min for x in terrain_data])
-        global_y_max = max([x.y_max for x in terrain_data])
+        global_x_min = terrain_data.x_min
+        global_x_max = terrain_data.x_max
+        global_y_min = terrain_data.y_min
+        global_y_max = terrain_data.y_max
 
         total_pts_number_x = int((global_x_max - global_x_min) / self.render_resolution)
         total_pts_number_y = int((global_y_max - global_y_min) / self.render_resolution)
 
+        # Number of terrain file points between two rendered points
+        index_step = int(round(self.render_resolution / self.file_resolution))
+
         range_x = range(total_pts_number_x)
         range_y = range(total_pts_number_y)
 
-        previous_terrain_line = None
-
-        for y in range_y:
-
-            current_terrain_line = []
-
-            current_point_y = global_y_min + y * self.render_resolution
-
-            for x in range_x:
+        texture_executor = None
+        texture_futures = {}
 
-                current_point_x = global_x_min + x * self.render_resolution
+        if use_sat_img:
+            # Textures are created while the meshes are being built, and only waited for when assigning the materials.
+            # They are keyed by mesh box, a mesh without a prefetched texture gets it created on demand.
+            texture_executor = ThreadPoolExecutor(
+                max_workers=max(1, self.texture_workers)
+            )
+            texture_futures = {
+                mesh_box: texture_executor.submit(
+                    Loader.Loader.load_texture,
+                    self.base_folder,
+                    mesh_box,
+                    self.texture_cache,
+                    self.texture_resolution,
+                )
+                for mesh_box in self.__mesh_boxes(
+                    terrain_data, box, total_pts_number_x, total_pts_number_y
+                ).values()
+            }
 
-                # Checking if the current point is in the current dataset
-                is_point_in_current_terrain = True
-                is_point_in_current_terrain &= current_point_x >= current_terrain.x_min
-                is_point_in_current_terrain &= current_point_x < current_terrain.x_max
-                is_point_in_current_terrain &= current_point_y >= current_terrain.y_min
-                is_point_in_current_terrain &= current_point_y < current_terrain.y_max
+        try:
+            previous_terrain_line = None
 
-                if not is_point_in_current_terrain:
+            for y in range_y:
 
-                    for terrain in terrain_data:
-                        is_point_in_terrain = True
-                        is_point_in_terrain &= current_point_x >= terrain.x_min
-                        is_point_in_terrain &= current_point_x < terrain.x_max
-                        is_point_in_terrain &= current_point_y >= terrain.y_min
-                        is_point_in_terrain &= current_point_y < terrain.y_max
+                current_terrain_line = []
 
-                        if is_point_in_terrain:
-                            current_terrain = terrain
-                            terrain_index = terrain_data.index(current_terrain)
-                            break
+                current_point_y = global_y_min + y * self.render_resolution
 
-                current_point_index_x = (
-                    current_point_x - current_terrain.x_min
-                ) / self.file_resolution
                 # Y axis is pointing north so the index needs to be inversed
-                current_point_index_y = 999 - (
-                    (current_point_y - current_terrain.y_min) / self.file_resolution
-                )
-
-                if (
-                    current_point_index_x != int(current_point_index_x)
-                    or current_point_index_x > current_terrain.nbcol
-                    or current_point_index_y != int(current_point_index_y)
-                    or current_point_index_y > current_terrain.nbrow
-                    or current_point_index_x < 0
-                    or current_point_index_y < 0
-                ):
-                    # TODO: Fix this.
-                    # Sometimes slabs are missing, when they're too far out to sea.
-                    # This make the terrain render correctly but it attaches the points lying in the missing slab to another slab, which screws up the texture.
-
-                    # print("INVALID POINT INDEX: ")
-                    # print("x: " + str(current_point_x) + " y: " + str(current_point_y))
-                    # print(
-                    #    "i_x "
-                    #    + str(current_point_index_x)
-                    #    + " i_y: "
-                    #    + str(current_point_index_y)
-                    # )
-
-                    # raise ValueError()
-                    current_point_z = 0
-                else:
-                    current_point_z = current_terrain.data.values[
-                        int(current_point_index_y)
-                    ][int(current_point_index_x)]
-
-                current_point_coords = [
-                    current_point_x,
-                    current_point_y,
-                    current_point_z,
+                current_terrain_row = terrain_data.data[
+                    terrain_data.nbrow - 1 - y * index_step
                 ]
 
-                current_terrain_line.append(current_point_coords)
-
-                if previous_terrain_line is not None and x > 0:
-
-                    new_face_verts = [
-                        center_point(current_terrain_line[x], center),
-                        center_point(current_terrain_line[x - 1], center),
-                        center_point(previous_terrain_line[x - 1], center),
-                        center_point(previous_terrain_line[x], center),
-                    ]
-
-                    new_face_mesh_verts = []
-                    for pt in new_face_verts:
-                        if pt not in meshes_points[previous_point_terrain_index]:
-                            meshes_points[previous_point_terrain_index][pt] = meshes[
-                                previous_point_terrain_index
-                            ].mesh.verts.new(pt)
-                        new_face_mesh_verts.append(
-                            meshes_points[previous_point_terrain_index][pt]
-                        )
-
-                    # Checking if the point is inside the window
-                    is_point_in_window = True
-                    is_point_in_window &= current_point_x >= box[0] - 1
-                    is_point_in_window &= current_point_x < box[2] + 1
-                    is_point_in_window &= current_point_y >= box[1] - 1
-                    is_point_in_window &= current_point_y < box[3] + 1
-
-                    if is_point_in_window:
-                        # Some checks will be superfluous, but better be safe than sorry
-                        TerrainRenderer.__check_boundaries(
-                            current_terrain_line[x],
-                            meshes[previous_point_terrain_index],
-                        )
-                        TerrainRenderer.__check_boundaries(
-                            current_terrain_line[x - 1],
-                            meshes[previous_point_terrain_index],
-                        )
-                        TerrainRenderer.__check_boundaries(
-                            previous_terrain_line[x - 1],
-                            meshes[previous_point_terrain_index],
-                        )
-                        TerrainRenderer.__check_boundaries(
-                            previous_terrain_line[x],
-                            meshes[previous_point_terrain_index],
-                        )
+                for x in range_x:
 
-                        face = meshes[previous_point_terrain_index].mesh.faces.new(
-                            new_face_mesh_verts
-                        )
+                    current_point_x = global_x_min + x * self.render_resolution
 
-                previous_point_terrain_index = terrain_index
+                    terrain_index = terrain_data.slab_index(
+                        current_point_x, current_point_y
+                    )
 
-            previous_terrain_line = current_terrain_line
+                    # Missing slabs are filled with a height of 0 in the mosaic
+                    current_point_z = float(current_terrain_row[x * index_step])
 
-        for index, mesh_info in meshes.items():
+                    current_point_coords = [
+                        current_point_x,
+                        current_point_y,
+                        current_point_z,
+                    ]
 
-            pts_number_x = int(
-                (mesh_info.x_max - mesh_info.x_min) / self.render_resolution
-            )
-            pts_number_y = int(
-                (mesh_info.y_max - mesh_info.y_min) / self.render_resolution
-            )
+                    current_terrain_line.append(current_point_coords)
+
+                    if previous_terrain_line is not None and x > 0:
+
+                        new_face_verts = [
+                            center_point(current_terrain_line[x], center),
+                            center_point(current_terrain_line[x - 1], center),
+                            center_point(previous_terrain_line[x - 1], center),
+                            center_point(previous_terrain_line[x], center),
+                        ]
+
+                        new_face_mesh_verts = []
+                        for pt in new_face_verts:
+                            if pt not in meshes_points[previous_point_terrain_index]:
+                                meshes_points[previous_point_terrain_index][pt] = (
+                                    meshes[previous_point_terrain_index].mesh.verts.new(
+                                        pt
+                                    )
+                                )
+                            new_face_mesh_verts.append(
+                                meshes_points[previous_point_terrain_index][pt]
+                            )
+
+                        # Checking if the point is inside the window
+                        is_point_in_window = True
+                        is_point_in_window &= current_point_x >= box[0] - 1
+                        is_point_in_window &= current_point_x < box[2] + 1
+                        is_point_in_window &= current_point_y >= box[1] - 1
+                        is_point_in_window &= current_point_y < box[3] + 1
+
+                        if is_point_in_window:
+                            # Some checks will be superfluous, but better be safe than sorry
+                            TerrainRenderer.__check_boundaries(
+                                current_terrain_line[x],
+                                meshes[previous_point_terrain_index],
+                            )
+                            TerrainRenderer.__check_boundaries(
+                                current_terrain_line[x - 1],
+                                meshes[previous_point_terrain_index],
+                            )
+                            TerrainRenderer.__check_boundaries(
+                                previous_terrain_line[x - 1],
+                                meshes[previous_point_terrain_index],
+                            )
+                            TerrainRenderer.__check_boundaries(
+                                previous_terrain_line[x],
+                                meshes[previous_point_terrain_index],
+                            )
+
+                            face = meshes[previous_point_terrain_index].mesh.faces.new(
+                                new_face_mesh_verts
+                            )
+
+                    previous_point_terrain_index = terrain_index
+
+                previous_terrain_line = current_terrain_line
+
+            for index, mesh_info in meshes.items():
+
+                if mesh_info.x_min == math.inf:
+                    # No point of this slab is inside the window
+                    mesh_info.mesh.free()
+                    continue
+
+                pts_number_x = int(
+                    (mesh_info.x_max - mesh_info.x_min) / self.render_resolution
+                )
+                pts_number_y = int(
+                    (mesh_info.y_max - mesh_info.y_min) / self.render_resolution
+                )
 
-            mesh_name = self._mesh_name + "_" + str(index)
-            mesh_data = D.meshes.new(mesh_name)
+                mesh_name = self._mesh_name + "_" + str(index)
+                mesh_data = D.meshes.new(mesh_name)
 
-            mesh_info.mesh.to_mesh(mesh_data)
-            mesh_info.mesh.free()
-            mesh_obj = D.objects.new(mesh_data.name, mesh_data)
-            mesh_material = D.materials[self._BaseMaterialName].copy()
+                mesh_info.mesh.to_mesh(mesh_data)
+                mesh_info.mesh.free()
+                mesh_obj = D.objects.new(mesh_data.name, mesh_data)
+                mesh_material = D.materials[self._BaseMaterialName].copy()
 
-            if use_sat_img:
+                if use_sat_img:
 
-                try:
-                    texture_file_path = Loader.Loader.load_texture(
-                        self.base_folder,
-                        (
+                    try:
+                        mesh_box = (
                             mesh_info.x_min,
                             mesh_info.y_min,
                             mesh_info.x_max,
                             mesh_info.y_max,
-                        ),
-                    )
-
-                    D.images.load(texture_file_path)
-
-                    mesh_material.node_tree.nodes["Image Texture"].image = D.images[
-                        os.path.basename(texture_file_path)
-                    ]
-                except Exception as e:
-                    print("Couldn't add texture image to slab: " + str(e))
+                        )
 
-            mesh_data.materials.append(mesh_material)
+                        if mesh_box in texture_futures:
+                            texture_file_path = texture_futures[mesh_box].result()
+                        else:
+                            texture_file_path = Loader.Loader.load_texture(
+                                self.base_folder,
+                                mesh_box,
+                                self.texture_cache,
+                                self.texture_resolution,
+                            )
+
+                        texture_image = D.images.load(texture_file_path)
+                        # Blender only reads the pixels when rendering. Packing them now keeps the texture once its
+                        # file is evicted from the cache.
+                        texture_image.pack()
+
+                        mesh_material.node_tree.nodes["Image Texture"].image = (
+                            texture_image
+                        )
+                    except Exception as e:
+                        print("Couldn't add texture image to slab: " + str(e))
 
-            terrain_collection.objects.link(mesh_obj)
+                mesh_data.materials.append(mesh_material)
 
-            uv_coords = [
-                (1 / (pts_number_x), 1 / (pts_number_y)),
-                (0, 1 / (pts_number_y)),
-                (0, 0),
-                (1 / (pts_number_x), 0),
-            ]
+                terrain_collection.objects.link(mesh_obj)
 
-            uvlayer = mesh_obj.data.uv_layers.new(name="UVMap_Terrain")
+                uv_coords = [
+                    (1 / (pts_number_x), 1 / (pts_number_y)),
+                    (0, 1 / (pts_number_y)),
+                    (0, 0),
+                    (1 / (pts_number_x), 0),
+                ]
 
-            for face in mesh_obj.data.polygons:
+                uvlayer = mesh_obj.data.uv_layers.new(name="UVMap_Terrain")
 
-                # Each face has 4 loops (sides), and starts in the lower left corner (xmin, ymin)
-                start_coord_x = (
-                    1 / pts_number_x * ((face.loop_start // 4) % pts_number_x)
-                )
-                start_coord_y = (
-                    1 / pts_number_y * (face.loop_start // (pts_number_x * 4))
-                )
+                for face in mesh_obj.data.polygons:
 
-                start_coord = (start_coord_x, start_coord_y)
-                for loop_idx in face.loop_indices:
-                    cur_coord = uv_coords[loop_idx % 4]
-                    uvlayer.data[loop_idx].uv = (
-                        start_coord[0] + cur_coord[0],
-                        start_coord[1] + cur_coord[1],
+                    # Each face has 4 loops (sides), and starts in the lower left corner (xmin, ymin)
+                    start_coord_x = (
+                        1 / pts_number_x * ((face.loop_start // 4) % pts_number_x)
+                    )
+                    start_coord_y = (
+                        1 / pts_number_y * (face.loop_start // (pts_number_x * 4))
                     )
 
+                    start_coord = (start_coord_x, start_coord_y)
+                    for loop_idx in face.loop_indices:
+                        cur_coord = uv_coords[loop_idx % 4]
+                        uvlayer.data[loop_idx].uv = (
+                            start_coord[0] + cur_coord[0],
+                            start_coord[1] + cur_coord[1],
+                        )
+        finally:
+            # If building the meshes failed, the textures that are not being created yet are cancelled
+            if texture_executor is not None:
+                texture_executor.shutdown(cancel_futures=True)
+                # The textures are packed in the scene, their files can now be evicted
+                self.texture_cache.release()
+
         # Merging all slabs of terrain into one object to enable shrinkwrap of road later
         bpy.ops.object.select_all(action="DESELECT")
         C.view_layer.objects.active = D.collections[parent_collection_name].objects[0]
@@ -286,6 +303,65 @@ class TerrainRenderer:
 
         O.object.join()
 
+    def __mesh_boxes(
+        self,
+        terrain_data: TerrainMosaic,
+        box: tuple[float, float, float, float],
+        total_pts_number_x: int,
+        total_pts_number_y: int,
+    ) -> dict[int, tuple[float, float, float, float]]:
+        """
+        Computes the bounding boxes the slab meshes will have once built by render, without building them.
+        A face is indexed by its upper right point. It belongs to the slab of its upper left point, and is kept if its
+        upper right point is in the window.
+        Both conditions are independent on the x and y axes, so they can be computed per axis.
+        :return: the bounding box of each slab mesh that has at least one face, by slab index
+        """
+        points_x = (
+            terrain_data.x_min + np.arange(total_pts_number_x) * self.render_resolution
+        )
+        points_y = (
+            terrain_data.y_min + np.arange(total_pts_number_y) * self.render_resolution
+        )
+
+        def kept_faces(points, box_min, box_max, edges, previous_slab):
+            # Index of the slab of each point, same as TerrainMosaic.slab_index
+            slabs = (
+                np.clip(np.searchsorted(edges, points, side="right"), 1, len(edges) - 1)
+                - 1
+            )
+
+            in_window = (points >= box_min - 1) & (points < box_max + 1)
+            in_window[0] = False
+
+            # On the x axis, the face belongs to the slab of the previous point
+            face_slabs = np.roll(slabs, 1) if previous_slab else slabs
+
+            return {
+                slab: np.flatnonzero(in_window & (face_slabs == slab))
+                for slab in range(len(edges) - 1)
+            }
+
+        faces_x = kept_faces(points_x, box[0], box[2], terrain_data.x_edges, True)
+        faces_y = kept_faces(points_y, box[1], box[3], terrain_data.y_edges, False)
+
+        mesh_boxes = {}
+        nb_slabs_x = len(terrain_data.x_edges) - 1
+
+        for slab_y, indexes_y in faces_y.items():
+            for slab_x, indexes_x in faces_x.items():
+                if len(indexes_x) == 0 or len(indexes_y) == 0:
+                    continue
+
+                mesh_boxes[slab_y * nb_slabs_x + slab_x] = (
+                    float(points_x[indexes_x[0] - 1]),
+                    float(points_y[indexes_y[0] - 1]),
+                    float(points_x[indexes_x[-1]]),
+                    float(points_y[indexes_y[-1]]),
+                )
+
+        return mesh_boxes
+
     @staticmethod
     def __check_boundaries(point, terrain_mesh_info):
 
@@ -0,0 +1,450 @@
+import os
+import json
+import hashlib
+import contextlib
+import dataclasses
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows
+    fcntl = None
+
+import geopandas as g
+import numpy as np
+import pandas as p
+import shapely
+from shapely.geometry import LineString
+
+from mage_procgen.Utils.Utils import (
+    TerrainData,
+    RenderingData,
+    GeoWindow,
+    LineStringList,
+)
+from mage_procgen.Utils.Config import Config
+
+
+class FileCache:
+    """
+    On-disk cache stored in a single folder. An entry is made of one or more files sharing the same key as file stem.
+    The least recently used entries are evicted when the total size of the folder goes over the size cap.
+    """
+
+    _tmp_extension = ".tmp"
+    # Files of the folder that are not part of the entries
+    _ignored_extensions = (_tmp_extension,)
+    # Files that are not part of the entries, but are removed with them
+    _companion_extensions = ()
+
+    def __init__(self, folder: str, max_size: float):
+        """
+        :param folder: the folder in which the cache entries are stored
+        :param max_size: the maximum size of the cache, in bytes
+        """
+        self.folder = folder
+        self.max_size = max_size
+
+        os.makedirs(self.folder, exist_ok=True)
+
+    @staticmethod
+    def file_key(file_path: str, *extra) -> str:
+        """
+        Computes the key of a source file, which changes whenever the file is modified.
+        :param file_path: the path of the source file
+        :param extra: additional values that will be part of the key
+        :return: the key of the file
+        """
+        file_stat = os.stat(file_path)
+        key_content = "|".join(
+            [
+                os.path.realpath(file_path),
+                str(file_stat.st_size),
+                str(file_stat.st_mtime_ns),
+            ]
+            + [str(x) for x in extra]
+        )
+
+        return hashlib.sha1(key_content.encode()).hexdigest()
+
+    def entry_path(self, key: str, extension: str) -> str:
+        return os.path.join(self.folder, key + extension)
+
+    def touch(self, key: str, extensions: list[str]):
+        """
+        Marks an entry as recently used
+        """
+        for extension in extensions:
+            os.utime(self.entry_path(key, extension))
+
+    def write_atomic(self, key: str, extension: str, write_function):
+        """
+        Writes a file of an entry in a temporary file, then renames it so readers never see a partial file.
+        :param write_function: function taking the path of the file to write
+        """
+        final_path = self.entry_path(key, extension)
+        tmp_path = final_path + "." + str(os.getpid()) + self._tmp_extension
+
+        try:
+            write_function(tmp_path)
+            os.replace(tmp_path, final_path)
+        finally:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+
+    def evict(self, keep: list[str] = ()):
+        """
+        Removes the least recently used entries until the cache fits its size cap
+        :param keep: keys of entries that must not be removed
+        """
+        entries = {}
+        for file_name in os.listdir(self.folder):
+            if file_name.endswith(self._ignored_extensions):
+                continue
+
+            key = file_name.split(".")[0]
+            file_path = os.path.join(self.folder, file_name)
+            try:
+                file_stat = os.stat(file_path)
+            except FileNotFoundError:
+                # Another process may have evicted it already
+                continue
+
+            size, last_use, files = entries.get(key, (0, 0, []))
+            entries[key] = (
+                size + file_stat.st_size,
+                max(last_use, file_stat.st_mtime),
+                files + [file_path],
+            )
+
+        total_size = sum([x[0] for x in entries.values()])
+
+        for key, (size, last_use, files) in sorted(
+            entries.items(), key=lambda x: x[1][1]
+        ):
+            if total_size <= self.max_size:
+                break
+
+            if key in keep:
+                continue
+
+            for file_path in files + [
+                self.entry_path(key, x) for x in self._companion_extensions
+            ]:
+                try:
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    # Another process may have evicted it already
+                    pass
+            total_size -= size
+
+
+class TerrainTileCache(FileCache):
+    """
+    Cache of parsed terrain slabs. Grids are stored as .npy files that are memory-mapped when read back,
+    and the rest of the TerrainData is stored in a .json file next to it.
+    """
+
+    _data_extension = ".npy"
+    _header_extension = ".json"
+
+    def get(self, file_path: str) -> TerrainData | None:
+        """
+        Gets the parsed slab corresponding to a slab file, if it is in the cache
+        :param file_path: the path of the .asc file
+        :return: the TerrainData of the slab, or None if it is not cached
+        """
+        key = self.file_key(file_path)
+
+        data_path = self.entry_path(key, self._data_extension)
+        header_path = self.entry_path(key, self._header_extension)
+
+        if not (os.path.isfile(data_path) and os.path.isfile(header_path)):
+            return None
+
+        try:
+            with open(header_path, "r") as f:
+                header = json.load(f)
+
+            grid = np.load(data_path, mmap_mode="r")
+            self.touch(key, [self._data_extension, self._header_extension])
+        except (OSError, ValueError):
+            # Entry was evicted or is being replaced
+            return None
+
+        return TerrainData(
+            header["x_min"],
+            header["y_min"],
+            header["x_max"],
+            header["y_max"],
+            header["resolution"],
+            header["nbcol"],
+            header["nbrow"],
+            header["no_data"],
+            p.DataFrame(grid, copy=False),
+        )
+
+    def put(self, file_path: str, terrain_data: TerrainData):
+        """
+        Stores a parsed slab in the cache, and evicts old entries if needed
+        :param file_path: the path of the .asc file
+        :param terrain_data: the TerrainData parsed from the file
+        """
+        key = self.file_key(file_path)
+
+        header = {
+            "x_min": terrain_data.x_min,
+            "y_min": terrain_data.y_min,
+            "x_max": terrain_data.x_max,
+            "y_max": terrain_data.y_max,
+            "resolution": terrain_data.resolution,
+            "nbcol": terrain_data.nbcol,
+            "nbrow": terrain_data.nbrow,
+            "no_data": terrain_data.no_data,
+        }
+
+        def write_data(path):
+            with open(path, "wb") as f:
+                np.save(f, np.ascontiguousarray(terrain_data.data.values))
+
+        def write_header(path):
+            with open(path, "w") as f:
+                json.dump(header, f)
+
+        # Data first, so that an entry with a header always has its data
+        self.write_atomic(key, self._data_extension, write_data)
+        self.write_atomic(key, self._header_extension, write_header)
+
+        self.evict()
+
+
+class TextureCache(FileCache):
+    """
+    Cache of terrain textures. Creating an entry is protected by a lock file per key, so that several processes sharing
+    the same base folder create each texture only once.
+    Textures returned by get_or_create are in use until they are released, and are not evicted before that.
+    """
+
+    _texture_extension = ".tif"
+    _lock_extension = ".lock"
+    _ignored_extensions = (FileCache._tmp_extension, _lock_extension)
+    # Lock files are only removed once their texture is evicted. If another process still creates the texture, at
+    # worst it is created twice, atomic writes prevent partial files.
+    _companion_extensions = (_lock_extension,)
+
+    def __init__(self, folder: str, max_size: float):
+        """
+        :param folder: the folder in which the cache entries are stored
+        :param max_size: the maximum size of the cache, in bytes
+        """
+        super().__init__(folder, max_size)
+
+        # Textures are created by several threads
+        self._in_use_lock = threading.Lock()
+        self._in_use = set()
+
+    def get_or_create(self, key: str, create_function) -> str:
+        """
+        Gets the texture of a key, creating it if it is not in the cache. The texture is in use until release is called.
+        :param key: the key of the texture
+        :param create_function: function taking the path of the texture file to write
+        :return: the path of the texture file
+        """
+        texture_path = self.entry_path(key, self._texture_extension)
+
+        with self._in_use_lock:
+            self._in_use.add(key)
+
+        with self.lock(key):
+            if os.path.isfile(texture_path):
+                self.touch(key, [self._texture_extension])
+                return texture_path
+
+            self.write_atomic(key, self._texture_extension, create_function)
+
+        # The textures that have been created but not loaded yet can't be evicted
+        with self._in_use_lock:
+            keep = set(self._in_use)
+        self.evict(keep=keep)
+
+        return texture_path
+
+    def release(self):
+        """
+        Marks all the textures returned by get_or_create as no longer in use, and evicts old entries if needed
+        """
+        with self._in_use_lock:
+            self._in_use.clear()
+
+        self.evict()
+
+    @contextlib.contextmanager
+    def lock(self, key: str):
+        """
+        Holds an exclusive lock on a key, shared between threads and processes
+        """
+        if fcntl is None:
+            # Without locks, atomic writes still prevent partial files, at worst a texture is created twice
+            yield
+            return
+
+        with open(self.entry_path(key, self._lock_extension), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class RenderingDataCache(FileCache):
+    """
+    Cache of preprocessed rendering data, so that a window can be rendered again without loading and preprocessing its
+    vector data. Each dataframe is stored as a GeoParquet file, the lanes are stored as their coordinates in a .npz file,
+    and a .json file written last lists the dataframes of the entry.
+    """
+
+    _frame_extension = ".parquet"
+    _lanes_extension = ".npz"
+    _header_extension = ".json"
+    _frames = "frames"
+    _departements = "departements"
+    _lanes = "lanes"
+    _lanes_coordinates = "coordinates"
+    _lanes_counts = "counts"
+    # Must be increased whenever the preprocessing or the stored format changes, so that older entries are not used
+    _version = 1
+
+    @staticmethod
+    def key(geo_window: GeoWindow, config: Config, input_files: list[str]) -> str:
+        """
+        Computes the key of the rendering data of a window, which changes whenever the window, the parameters of the
+        preprocessing or the input files change.
+        :param geo_window: the window of the scene
+        :param config: the config of the scene
+        :param input_files: the files the vector data of the window is loaded from
+        :return: the key of the rendering data
+        """
+        key_content = "|".join(
+            [
+                str(RenderingDataCache._version),
+                shapely.to_wkb(geo_window.mask, hex=True),
+                config.window_type,
+                json.dumps(config.building_usages, sort_keys=True),
+            ]
+            + [FileCache.file_key(x) for x in input_files]
+        )
+
+        return hashlib.sha1(key_content.encode()).hexdigest()
+
+    def get(self, key: str) -> tuple[RenderingData, g.GeoDataFrame] | None:
+        """
+        Gets cached rendering data
+        :param key: the key of the rendering data
+        :return: the rendering data and the departements of the window, or None if they are not cached
+        """
+        header_path = self.entry_path(key, self._header_extension)
+
+        if not os.path.isfile(header_path):
+            return None
+
+        try:
+            with open(header_path, "r") as f:
+                header = json.load(f)
+
+            frames = {
+                x: g.read_parquet(self.__frame_path(key, x))
+                for x in header[self._frames]
+            }
+
+            with np.load(self.entry_path(key, self._lanes_extension)) as lanes_file:
+                lanes = RenderingDataCache.__decode_lanes(
+                    lanes_file[self._lanes_coordinates],
+                    lanes_file[self._lanes_counts],
+                )
+
+            self.touch(
+                key,
+                [self._header_extension, self._lanes_extension]
+                + [self.__frame_extension(x) for x in header[self._frames]],
+            )
+        except (OSError, ValueError):
+            # Entry was evicted or is being replaced
+            return None
+
+        departements = frames.pop(self._departements)
+
+        # Dataframes that were None are not stored
+        rendering_data = RenderingData(
+            **{
+                x.name: frames.get(x.name)
+                for x in dataclasses.fields(RenderingData)
+                if x.name != self._lanes
+            },
+            lanes=lanes,
+        )
+
+        return rendering_data, departements
+
+    def put(
+        self, key: str, rendering_data: RenderingData, departements: g.GeoDataFrame
+    ):
+        """
+        Stores rendering data in the cache, and evicts old entries if needed
+        :param key: the key of the rendering data
+        :param rendering_data: the rendering data of the window
+        :param departements: the departements of the window
+        """
+        frames = {
+            x.name: getattr(rendering_data, x.name)
+            for x in dataclasses.fields(RenderingData)
+            if x.name != self._lanes and getattr(rendering_data, x.name) is not None
+        }
+        frames[self._departements] = departements
+
+        lanes = np.asarray(rendering_data.lanes, dtype=object)
+
+        def write_lanes(path):
+            with open(path, "wb") as f:
+                np.savez(
+                    f,
+                    **{
+                        self._lanes_coordinates: shapely.get_coordinates(lanes),
+                        self._lanes_counts: shapely.get_num_coordinates(lanes),
+                    },
+                )
+
+        def write_header(path):
+            with open(path, "w") as f:
+                json.dump({self._frames: list(frames.keys())}, f)
+
+        for name, frame in frames.items():
+            self.write_atomic(
+                key, self.__frame_extension(name), lambda path: frame.to_parquet(path)
+            )
+        self.write_atomic(key, self._lanes_extension, write_lanes)
+
+        # Header last, so that an entry with a header has all its files
+        self.write_atomic(key, self._header_extension, write_header)
+
+        self.evict()
+
+    def __frame_extension(self, name: str) -> str:
+        return "." + name + self._frame_extension
+
+    def __frame_path(self, key: str, name: str) -> str:
+        return self.entry_path(key, self.__frame_extension(name))
+
+    @staticmethod
+    def __decode_lanes(coordinates: np.ndarray, counts: np.ndarray) -> LineStringList:
+        lanes = np.full(len(counts), LineString(), dtype=object)
+
+        # Empty lanes have no coordinates
+        is_filled = counts > 0
+        if is_filled.any():
+            lanes[is_filled] = shapely.linestrings(
+                coordinates,
+                indices=np.repeat(np.arange(is_filled.sum()), counts[is_filled]),
+            )
+
+        return lanes.tolist()
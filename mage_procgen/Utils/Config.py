@@ -1,9 +1,14 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 window_type_coords = "COORDS"
 window_type_town = "TOWN"
 window_type_file = "FILE"
 
+building_type_church = "CHURCH"
+building_type_mall = "MALL"
+building_type_factory = "FACTORY"
+building_type_default = "DEFAULT"
+
 
 @dataclass
 class RenderObjectConfig:
@@ -47,3 +52,33 @@ class Config:
     road_render_config: RenderObjectConfig
     water_render_config: RenderObjectConfig
     car_render_config: RenderObjectConfig
+    # Building type of each USAGE1 tag of the BDTOPO. Buildings with other tags are default buildings
+    building_usages: dict[str, str] = field(
+        default_factory=lambda: {
+            "Religieux": building_type_church,
+            "Commercial et services": building_type_mall,
+            "Industriel": building_type_factory,
+        }
+    )
+    # Size of the on-disk cache of parsed terrain slabs, in MB. 0 disables the cache
+    terrain_cache_size: float = 2048
+    # If True, only the part of the terrain slabs around the window is loaded
+    crop_terrain: bool = True
+    # Margin kept around the window when cropping terrain slabs, in m
+    terrain_crop_margin: float = 20
+    # Number of processes used to parse terrain slabs
+    terrain_load_workers: int = 1
+    # Number of threads used to read shapefiles
+    shapefile_load_workers: int = 8
+    # Ground size of a pixel of the terrain textures, in m. 0 uses out_img_pixel_size
+    texture_resolution: float = 0
+    # Size of the on-disk cache of terrain textures, in MB. 0 disables the cache
+    texture_cache_size: float = 4096
+    # Number of threads used to create terrain textures
+    texture_load_workers: int = 4
+    # Number of processes used to polygonise roads
+    road_preprocess_workers: int = 1
+    # Number of roads polygonised by each task when using several processes
+    road_chunk_size: int = 5000
+    # Size of the on-disk cache of preprocessed vector data, in MB. 0 disables the cache
+    rendering_data_cache_size: float = 1024
@@ -91,6 +91,22 @@ def generate_config(new_file_name: str, **kwargs):
         car_render_config_geometry_node_file (str): Name of the asset file for cars
         car_render_config_geometry_node_name (str): Name of the geometry node setup for cars
         car_render_config_tagging_index (int): Index using which cars will be tagged in the semantic map
+
+    Other parameters: Building classification:
+        building_usages (dict): Building type of each USAGE1 tag of the BDTOPO. Types are "CHURCH", "MALL", "FACTORY" and "DEFAULT". Buildings with other tags are default buildings.
+
+    Other parameters: Performance parameters:
+        terrain_cache_size (float): Size of the on-disk cache of parsed terrain slabs, in MB. 0 disables the cache.
+        crop_terrain (bool): If True, only the part of the terrain slabs around the window is loaded.
+        terrain_crop_margin (float): Margin kept around the window when cropping terrain slabs, in m.
+        terrain_load_workers (int): Number of processes used to parse terrain slabs.
+        shapefile_load_workers (int): Number of threads used to read shapefiles.
+        texture_resolution (float): Size of a pixel of the terrain textures, in m. 0 uses out_img_pixel_size.
+        texture_cache_size (float): Size of the cache of terrain textures, in MB. 0 disables the cache.
+        texture_load_workers (int): Number of threads used to create terrain textures.
+        road_preprocess_workers (int): Number of processes used to polygonise roads.
+        road_chunk_size (int): Number of roads polygonised by each task when using several processes.
+        rendering_data_cache_size (float): Size of the cache of preprocessed vector data, in MB. 0 disables the cache.
     """
     _location = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
     default_config_filepath = os.path.realpath(
@@ -271,6 +287,44 @@ def generate_config(new_file_name: str, **kwargs):
         base_config.car_render_config.tagging_index,
     )
 
+    # Building classification
+    new_config.building_usages = kwargs.get(
+        "building_usages", base_config.building_usages
+    )
+
+    # Performance
+    new_config.terrain_cache_size = kwargs.get(
+        "terrain_cache_size", base_config.terrain_cache_size
+    )
+    new_config.crop_terrain = kwargs.get("crop_terrain", base_config.crop_terrain)
+    new_config.terrain_crop_margin = kwargs.get(
+        "terrain_crop_margin", base_config.terrain_crop_margin
+    )
+    new_config.terrain_load_workers = kwargs.get(
+        "terrain_load_workers", base_config.terrain_load_workers
+    )
+    new_config.shapefile_load_workers = kwargs.get(
+        "shapefile_load_workers", base_config.shapefile_load_workers
+    )
+    new_config.texture_resolution = kwargs.get(
+        "texture_resolution", base_config.texture_resolution
+    )
+    new_config.texture_cache_size = kwargs.get(
+        "texture_cache_size", base_config.texture_cache_size
+    )
+    new_config.texture_load_workers = kwargs.get(
+        "texture_load_workers", base_config.texture_load_workers
+    )
+    new_config.road_preprocess_workers = kwargs.get(
+        "road_preprocess_workers", base_config.road_preprocess_workers
+    )
+    new_config.road_chunk_size = kwargs.get(
+        "road_chunk_size", base_config.road_chunk_size
+    )
+    new_config.rendering_data_cache_size = kwargs.get(
+        "rendering_data_cache_size", base_config.rendering_data_cache_size
+    )
+
     ConfigLoader.save(new_config, new_file_name)
     print("New config file generated at ", new_file_name)
 
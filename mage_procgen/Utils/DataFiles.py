@@ -2,6 +2,8 @@ import subprocess
 import os
 import re
 
+from mage_procgen.Parser.ShapeFileParser import ShapeFileParser, RoadShapeFileParser
+
 rendering = "rendering"
 
 temp_folder = "TMP"
@@ -41,7 +43,20 @@ building_file = "BATIMENT.shp"
 
 shore_file = "LIMITE_TERRE_MER.shp"
 
-texture_folder = "Textures"
+# Attributes read from each layer. Any other column of the files is not decoded.
+building_columns = ["USAGE1", "NB_ETAGES"]
+forest_columns = []
+road_columns = ["NATURE", "LARGEUR", "NB_VOIES", "SENS"]
+water_columns = ["NATURE"]
+dpt_columns = ["INSEE_DEP"]
+regions_columns = ["CODE_DEPT"]
+ocean_columns = []
+
+cache_folder = "Cache"
+terrain_cache_folder = "Terrain"
+texture_cache_folder = "Textures"
+rendering_data_cache_folder = "RenderingData"
+
 texture_image_DB = "BDORTHO"
 delivery = "1_DONNEES_LIVRAISON"
 texture_data_folder = "OHR_RVB"
@@ -133,6 +148,41 @@ def setup_bdtopo(base_folder: str, departement: str, archive_file: str):
         ),
     )
 
+    ingest_bdtopo(base_folder, departement)
+
+
+def ingest_bdtopo(base_folder: str, departement: str):
+    """
+    Converts the BDTOPO layers used by the application to GeoParquet files, stored next to the shapefiles.
+    Features are sorted spatially, so that reading a window only decodes the few row groups intersecting it.
+    Shapefiles are still used if the GeoParquet files are missing or older than them.
+    Called by setup_bdtopo, can also be called on a departement that was set up before.
+
+    Parameters:
+        base_folder: base folder of the application (same one as the one written in the config file)
+        departement: number of the departement as a 2 character string (ex: "06", "77" ...)
+    """
+
+    current_bdtopo_folder = os.path.join(
+        base_folder, departements, str(departement), bdtopo_folder, delivery
+    )
+
+    for layer_folder, layer_file in [
+        (building_folder, building_file),
+        (forest_folder, forest_file),
+        (water_folder, water_file),
+        (dpt_folder, dpt_file),
+    ]:
+        print("Ingesting " + layer_file)
+        ShapeFileParser.ingest(
+            os.path.join(current_bdtopo_folder, layer_folder, layer_file)
+        )
+
+    print("Ingesting " + road_file)
+    RoadShapeFileParser.ingest(
+        os.path.join(current_bdtopo_folder, road_folder, road_file)
+    )
+
 
 # TODO: delete the other folders ?
 def setup_bdortho(base_folder: str, departement: str, archive_file: str):
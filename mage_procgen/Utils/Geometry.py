@@ -1,6 +1,9 @@
 import math
-from shapely.geometry import Polygon, LineString, Point
-from mage_procgen.Utils.Utils import GeoWindow
+
+import numpy as np
+import shapely
+from shapely.geometry import Polygon, LineString
+from mage_procgen.Utils.Utils import GeoWindow, TerrainMosaic, PolygonList, Point
 
 default_thickness = 4
 default_lane_nbr = 2
@@ -9,269 +12,285 @@ max_point_distance = 1000
 directions = ["Double sens", "Sens direct", "Sens inverse"]
 
 
-def polygonise(
-    poly_line: LineString,
-    thickness: float,
-    lane_nbr: int,
-    direction: str,
+def polygons_rings_3d(
+    polygons: PolygonList, terrain: TerrainMosaic
+) -> list[list[list[Point]]]:
+    """
+    Gets the rings of polygons, with the height of the terrain at each of their points.
+    The heights of the points of all the polygons are sampled at once.
+    :param polygons: the polygons
+    :param terrain: the terrain on which the polygons are
+    :return: for each polygon, its exterior then its holes, as lists of (x,y,z) points
+    """
+    rings, rings_polygons = shapely.get_rings(polygons, return_index=True)
+
+    points_xy = shapely.get_coordinates(rings)
+    points = np.column_stack([points_xy, terrain.sample(points_xy)]).tolist()
+
+    rings_ends = np.cumsum(shapely.get_num_coordinates(rings))
+    rings_starts = rings_ends - shapely.get_num_coordinates(rings)
+    rings_points = [
+        [tuple(x) for x in points[start:end]]
+        for start, end in zip(rings_starts, rings_ends)
+    ]
+
+    polygons_indexes = np.arange(len(polygons))
+    polygons_starts = np.searchsorted(rings_polygons, polygons_indexes, side="left")
+    polygons_ends = np.searchsorted(rings_polygons, polygons_indexes, side="right")
+
+    return [
+        rings_points[start:end] for start, end in zip(polygons_starts, polygons_ends)
+    ]
+
+
+def polygonise_roads(
+    poly_lines: list[LineString],
+    thicknesses: np.ndarray,
+    lanes_nbr: np.ndarray,
+    roads_directions: list[str],
     restrict_to_town: bool,
     window: GeoWindow,
-) -> Polygon:
+) -> list[tuple[list[Polygon], list[LineString]]]:
+    """
+    Polygonises all the roads at once. Each road becomes one quadrilateral per segment, the quadrilaterals of
+    consecutive segments sharing the intersections of their sides, and one line per lane. All the computations are done
+    on arrays containing the segments of all the roads.
+    :param poly_lines: the lines of the roads
+    :param thicknesses: the width of each road, nan if unknown
+    :param lanes_nbr: the number of lanes of each road, nan if unknown
+    :param roads_directions: the direction of each road
+    :param restrict_to_town: if True, lanes are restricted to the window
+    :param window: the window of the scene
+    :return: the polygons and the lanes of each road
+    """
+
+    roads_nbr = len(poly_lines)
+
+    thicknesses = np.asarray(thicknesses, dtype=float)
+    lanes_nbr = np.asarray(lanes_nbr, dtype=float)
 
-    translation_module = (
-        (thickness / 2) if not math.isnan(thickness) else (default_thickness / 2)
+    translation_modules = np.where(
+        np.isnan(thicknesses), default_thickness / 2, thicknesses / 2
+    )
+    lane_counts = np.where(np.isnan(lanes_nbr), default_lane_nbr, lanes_nbr).astype(int)
+    direction_codes = np.array(
+        [
+            directions.index(x) if x in directions else default_direction_code
+            for x in roads_directions
+        ],
+        dtype=int,
     )
 
-    polys = []
+    coords, points_road = shapely.get_coordinates(
+        np.asarray(poly_lines, dtype=object), return_index=True
+    )
 
-    direction_code = (
-        directions.index(direction)
-        if direction in directions
-        else default_direction_code
+    # Repeated points would create segments without normal
+    repeated = np.zeros(len(coords), dtype=bool)
+    repeated[1:] = (points_road[1:] == points_road[:-1]) & np.all(
+        coords[1:] == coords[:-1], axis=1
+    )
+    coords = coords[~repeated]
+    points_road = points_road[~repeated]
+
+    # Segments
+    is_segment_start = points_road[:-1] == points_road[1:]
+    segment_a = coords[:-1][is_segment_start]
+    segment_b = coords[1:][is_segment_start]
+    segments_road = points_road[:-1][is_segment_start]
+
+    segments_nbr = np.bincount(segments_road, minlength=roads_nbr)
+    roads_first_segment = np.concatenate([[0], np.cumsum(segments_nbr)])
+    segments_index = np.arange(len(segments_road)) - roads_first_segment[segments_road]
+    is_first_segment = segments_index == 0
+    is_last_segment = segments_index == segments_nbr[segments_road] - 1
+
+    normals = _normals(segment_a, segment_b)
+    segments_translation = translation_modules[segments_road][:, None]
+
+    p1 = segment_a + normals * segments_translation
+    p2 = segment_b + normals * segments_translation
+    p3 = segment_b - normals * segments_translation
+    p4 = segment_a - normals * segments_translation
+
+    # Each quad is intersected with the previous one, once the previous one has been intersected with its own
+    # previous one: the n-th segments of all the roads are processed together, after the (n-1)-th ones.
+    start1 = p1.copy()
+    start2 = p4.copy()
+
+    segments_by_index = np.argsort(segments_index, kind="stable")
+    index_bounds = np.concatenate([[0], np.cumsum(np.bincount(segments_index))])
+
+    for index in range(1, len(index_bounds) - 1):
+        current = segments_by_index[index_bounds[index] : index_bounds[index + 1]]
+        previous = current - 1
+
+        start1[current] = _line_intersections(
+            start1[previous], p2[previous], p1[current], p2[current], p1[current]
+        )
+        start2[current] = _line_intersections(
+            p3[previous], start2[previous], p3[current], p4[current], p4[current]
+        )
+
+    following = np.minimum(np.arange(len(segments_road)) + 1, len(segments_road) - 1)
+    end1 = np.where(is_last_segment[:, None], p2, start1[following])
+    end2 = np.where(is_last_segment[:, None], p3, start2[following])
+
+    quads = shapely.polygons(np.stack([start1, end1, end2, start2, start1], axis=1))
+
+    # Lanes: each segment is repeated once per lane of its road, and ordered by road, lane and segment
+    # Roads without segments have no lanes
+    lane_counts[segments_nbr == 0] = 0
+    lanes_road = np.repeat(np.arange(roads_nbr), lane_counts)
+    roads_first_lane = np.concatenate([[0], np.cumsum(lane_counts)])
+    lanes_index = np.arange(len(lanes_road)) - roads_first_lane[lanes_road]
+    lanes_count = lane_counts[lanes_road]
+    lanes_fraction = (2 * lanes_index + 1 - lanes_count) / lanes_count
+
+    lanes_segments_nbr = segments_nbr[lanes_road]
+    lane_segments_lane = np.repeat(np.arange(len(lanes_road)), lanes_segments_nbr)
+    lanes_first_lane_segment = np.concatenate([[0], np.cumsum(lanes_segments_nbr)])
+
+    # Index of the road segment corresponding to each lane segment
+    lane_segments = (
+        roads_first_segment[lanes_road[lane_segments_lane]]
+        + np.arange(len(lane_segments_lane))
+        - lanes_first_lane_segment[lane_segments_lane]
     )
 
-    lane_count = int(lane_nbr) if not math.isnan(lane_nbr) else default_lane_nbr
+    lane_translation = (
+        normals[lane_segments] * lanes_fraction[lane_segments_lane][:, None]
+    ) * segments_translation[lane_segments]
+    lane_p1 = segment_a[lane_segments] + lane_translation
+    lane_p2 = segment_b[lane_segments] + lane_translation
+
+    lane_previous = np.maximum(np.arange(len(lane_segments)) - 1, 0)
+    lane_inters = _line_intersections(
+        lane_p1[lane_previous], lane_p2[lane_previous], lane_p1, lane_p2, lane_p1
+    )
 
-    lanes = {}
-    lanes_previous_segment = {}
-    translation_fractions = [
-        x / lane_count for x in range(1 - lane_count, lane_count + 1, 2)
+    lane_is_first_segment = is_first_segment[lane_segments]
+
+    # Lanes being shapely lines, they cannot be windowed like other objects so we have to do it here
+    if restrict_to_town:
+        checked_points = np.where(lane_is_first_segment[:, None], lane_p1, lane_p2)
+        is_kept = window.contains_xy(checked_points[:, 0], checked_points[:, 1])
+    else:
+        is_kept = np.ones(len(lane_segments), dtype=bool)
+
+    # A kept segment adds its starting point (the intersection with the previous one if it is not the first).
+    # The last kept segment of the lane also adds its end point.
+    kept_segments = np.flatnonzero(is_kept)
+    kept_lane = lane_segments_lane[kept_segments]
+    is_last_kept = np.ones(len(kept_segments), dtype=bool)
+    is_last_kept[:-1] = kept_lane[:-1] != kept_lane[1:]
+
+    lane_points = np.concatenate(
+        [
+            np.where(
+                lane_is_first_segment[kept_segments, None],
+                lane_p1[kept_segments],
+                lane_inters[kept_segments],
+            ),
+            lane_p2[kept_segments[is_last_kept]],
+        ]
+    )
+    lane_points_lane = np.concatenate([kept_lane, kept_lane[is_last_kept]])
+    lane_points_order = np.concatenate(
+        [kept_segments, kept_segments[is_last_kept] + 0.5]
+    ).astype(float)
+
+    # Lanes going the other way are reversed
+    lanes_reversed = (direction_codes[lanes_road] == 2) | (
+        (direction_codes[lanes_road] == 0) & (lanes_fraction < 0)
+    )
+    lane_points_order[lanes_reversed[lane_points_lane]] *= -1
+
+    points_order = np.lexsort((lane_points_order, lane_points_lane))
+
+    # Geometries are immutable, so all the empty lanes can be the same object
+    lanes = np.full(len(lanes_road), LineString(), dtype=object)
+    non_empty_lanes = np.unique(lane_points_lane)
+    if len(non_empty_lanes) > 0:
+        lanes[non_empty_lanes] = shapely.linestrings(
+            lane_points[points_order],
+            indices=np.searchsorted(non_empty_lanes, lane_points_lane[points_order]),
+        )
+
+    return [
+        (
+            list(quads[roads_first_segment[i] : roads_first_segment[i + 1]]),
+            list(lanes[roads_first_lane[i] : roads_first_lane[i + 1]]),
+        )
+        for i in range(roads_nbr)
     ]
 
-    is_first_point = True
-    is_first_segment = True
-    previous_point = None
-
-    for point in poly_line.coords:
-
-        if not is_first_point:
-
-            current_segment = (previous_point, point)
-
-            current_normale = normal(current_segment)
-
-            # Adding the 4 new points
-            if is_first_segment:
-                p1 = (
-                    current_segment[0][0] + current_normale[0] * translation_module,
-                    current_segment[0][1] + current_normale[1] * translation_module,
-                )
-                p2 = (
-                    current_segment[1][0] + current_normale[0] * translation_module,
-                    current_segment[1][1] + current_normale[1] * translation_module,
-                )
-                p3 = (
-                    current_segment[1][0] - current_normale[0] * translation_module,
-                    current_segment[1][1] - current_normale[1] * translation_module,
-                )
-                p4 = (
-                    current_segment[0][0] - current_normale[0] * translation_module,
-                    current_segment[0][1] - current_normale[1] * translation_module,
-                )
-
-                polys.append([p1, p2, p3, p4, p1])
-
-                # Lanes
-                for fraction in translation_fractions:
-                    lane_p1 = (
-                        current_segment[0][0]
-                        + current_normale[0] * fraction * translation_module,
-                        current_segment[0][1]
-                        + current_normale[1] * fraction * translation_module,
-                    )
-                    lane_p2 = (
-                        current_segment[1][0]
-                        + current_normale[0] * fraction * translation_module,
-                        current_segment[1][1]
-                        + current_normale[1] * fraction * translation_module,
-                    )
-
-                    # Lanes being shapely lines, they cannot be windowed like other objects so we have to do it here
-                    skip_point = False
-                    if restrict_to_town:
-                        new_point = Point(lane_p1[0], lane_p1[1])
-                        town_poly = window.dataframe.geometry[0]
-                        skip_point = not new_point.within(town_poly)
-
-                    if not skip_point:
-                        lanes[fraction] = [lane_p1, lane_p2]
-                    else:
-                        lanes[fraction] = []
-                    lanes_previous_segment[fraction] = (lane_p1, lane_p2)
-
-                is_first_segment = False
-            else:
-
-                previous_quadri = polys[-1]
-
-                # 4 points of the new quadri
-                p1 = (
-                    current_segment[0][0] + current_normale[0] * translation_module,
-                    current_segment[0][1] + current_normale[1] * translation_module,
-                )
-                p2 = (
-                    current_segment[1][0] + current_normale[0] * translation_module,
-                    current_segment[1][1] + current_normale[1] * translation_module,
-                )
-                p3 = (
-                    current_segment[1][0] - current_normale[0] * translation_module,
-                    current_segment[1][1] - current_normale[1] * translation_module,
-                )
-                p4 = (
-                    current_segment[0][0] - current_normale[0] * translation_module,
-                    current_segment[0][1] - current_normale[1] * translation_module,
-                )
-
-                # Finding the correct intersection of the current quadri and the previous one
-                inters1 = line_intersection(
-                    (previous_quadri[0], previous_quadri[1]), (p1, p2)
-                )
-                inters2 = line_intersection(
-                    (previous_quadri[2], previous_quadri[3]), (p3, p4)
-                )
-
-                # In some edge cases, almost straight segments create very far points.
-                # In those cases, using the points of the new poly is a very fair approximation.
-                inters1_distance = math.sqrt(
-                    (inters1[0] - p1[0]) * (inters1[0] - p1[0])
-                    + (inters1[1] - p1[1]) * (inters1[1] - p1[1])
-                )
-                if inters1_distance > max_point_distance:
-                    inters1 = p1
-
-                inters2_distance = math.sqrt(
-                    (inters2[0] - p4[0]) * (inters2[0] - p4[0])
-                    + (inters2[1] - p4[1]) * (inters2[1] - p4[1])
-                )
-                if inters2_distance > max_point_distance:
-                    inters2 = p4
-
-                # Modifying the previous polygon
-                polys[-1][1] = inters1
-                polys[-1][2] = inters2
-
-                polys.append([inters1, p2, p3, inters2, inters1])
-
-                # Lanes
-                for fraction in translation_fractions:
-                    lane_p1 = (
-                        current_segment[0][0]
-                        + current_normale[0] * fraction * translation_module,
-                        current_segment[0][1]
-                        + current_normale[1] * fraction * translation_module,
-                    )
-                    lane_p2 = (
-                        current_segment[1][0]
-                        + current_normale[0] * fraction * translation_module,
-                        current_segment[1][1]
-                        + current_normale[1] * fraction * translation_module,
-                    )
-
-                    # Finding the correct intersection of the current segment and the previous one
-                    inters = line_intersection(
-                        (
-                            lanes_previous_segment[fraction][0],
-                            lanes_previous_segment[fraction][1],
-                        ),
-                        (lane_p1, lane_p2),
-                    )
-
-                    # In some edge cases, almost straight segments create very far points.
-                    # In those cases, using the points of the new poly is a very fair approximation.
-                    inters_distance = math.sqrt(
-                        (inters[0] - lane_p1[0]) * (inters[0] - lane_p1[0])
-                        + (inters[1] - lane_p1[1]) * (inters[1] - lane_p1[1])
-                    )
-                    if inters_distance > max_point_distance:
-                        inters = lane_p1
-
-                    # Lanes being shapely lines, they cannot be windowed like other objects so we have to do it here
-                    skip_point = False
-                    if restrict_to_town:
-                        new_point = Point(lane_p2[0], lane_p2[1])
-                        town_poly = window.dataframe.geometry[0]
-                        skip_point = not new_point.within(town_poly)
-
-                    if not skip_point:
-                        if len(lanes[fraction]) > 0:
-                            lanes[fraction] = lanes[fraction][:-1] + [inters, lane_p2]
-                        else:
-                            lanes[fraction] = [inters, lane_p2]
-                    lanes_previous_segment[fraction] = (lane_p1, lane_p2)
-        else:
-            is_first_point = False
-
-        previous_point = point
-
-    road_polygons = [Polygon(poly_points) for poly_points in polys]
-
-    if direction_code == 2:
-        # Flip all
-        for fraction in lanes.keys():
-            lanes[fraction].reverse()
-    if direction_code == 0:
-        # Flip < 0
-        for fraction in lanes.keys():
-            if fraction < 0:
-                lanes[fraction].reverse()
-
-    lanes_lines = [LineString(lane) for lane in lanes.values()]
-
-    return (road_polygons, lanes_lines)
-
-
-def normal(
-    line: tuple[tuple[float, float], tuple[float, float]]
-) -> tuple[float, float]:
+
+def _normals(points_a: np.ndarray, points_b: np.ndarray) -> np.ndarray:
     """
-    Calculates the normalized normal to the line
-    :param line:  the line you want to normal of
-    :return: the normalized normal of the vector
+    Computes the normalized normals of segments
     """
+    normal_vectors = np.stack(
+        [-(points_b[:, 1] - points_a[:, 1]), points_b[:, 0] - points_a[:, 0]], axis=1
+    )
+    normal_norms = np.sqrt(
+        normal_vectors[:, 0] * normal_vectors[:, 0]
+        + normal_vectors[:, 1] * normal_vectors[:, 1]
+    )
 
-    dx = line[1][0] - line[0][0]
-    dy = line[1][1] - line[0][1]
-
-    normal_vector = (-dy, dx)
+    return normal_vectors / normal_norms[:, None]
 
-    normal_norm = norm2d(normal_vector)
 
-    return (normal_vector[0] / normal_norm, normal_vector[1] / normal_norm)
+def _line_intersections(
+    lines1_a: np.ndarray,
+    lines1_b: np.ndarray,
+    lines2_a: np.ndarray,
+    lines2_b: np.ndarray,
+    reference_points: np.ndarray,
+) -> np.ndarray:
+    """
+    Computes the intersections of pairs of lines. Intersections that are too far from their reference points are
+    replaced by them.
+    """
+    xdiff = (lines1_a[:, 0] - lines1_b[:, 0], lines2_a[:, 0] - lines2_b[:, 0])
+    ydiff = (lines1_a[:, 1] - lines1_b[:, 1], lines2_a[:, 1] - lines2_b[:, 1])
 
+    def det(a, b):
+        return a[0] * b[1] - a[1] * b[0]
 
-def norm2d(vector):
-    return math.sqrt(vector[0] * vector[0] + vector[1] * vector[1])
+    div = det(xdiff, ydiff)
+    d = (det(lines1_a.T, lines1_b.T), det(lines2_a.T, lines2_b.T))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        intersections = np.stack([det(d, xdiff) / div, det(d, ydiff) / div], axis=1)
+
+    # Aligned lines: most times they share a point, which is then the intersection
+    def same(a, b):
+        return np.all(a == b, axis=1)[:, None]
+
+    aligned_fallback = np.where(
+        same(lines1_a, lines2_a) | same(lines1_a, lines2_b),
+        lines1_a,
+        np.where(
+            same(lines1_b, lines2_a) | same(lines1_b, lines2_b),
+            lines1_b,
+            0.0,
+        ),
+    )
+    intersections = np.where((div == 0)[:, None], aligned_fallback, intersections)
 
+    # In some edge cases, almost straight segments create very far points.
+    # In those cases, using the points of the new poly is a very fair approximation.
+    delta = intersections - reference_points
+    distances = np.sqrt(delta[:, 0] * delta[:, 0] + delta[:, 1] * delta[:, 1])
 
-def line_intersection(
-    line1: tuple[tuple[float, float], tuple[float, float]],
-    line2: tuple[tuple[float, float], tuple[float, float]],
-) -> tuple[float, float]:
-    xdiff = (line1[0][0] - line1[1][0], line2[0][0] - line2[1][0])
-    ydiff = (line1[0][1] - line1[1][1], line2[0][1] - line2[1][1])
+    return np.where(
+        (distances > max_point_distance)[:, None], reference_points, intersections
+    )
 
-    def det(a, b):
-        return a[0] * b[1] - a[1] * b[0]
 
-    div = det(xdiff, ydiff)
-    if div == 0:
-        # Most times it's when lines are aligned and share a point.
-        # In that case, returning the common point is completly valid.
-        if line1[0] == line2[0] or line1[0] == line2[1]:
-            return line1[0]
-        elif line1[1] == line2[0] or line1[1] == line2[1]:
-            return line1[1]
-        else:
-            # TODO: Better treatment of this: idealy should detect that the two lines are the same, and return something
-            print("line_intersection: ERROR: lines do not intersect: ")
-            print(str(line1))
-            print(str(line2))
-            return 0, 0
-
-    d = (det(*line1), det(*line2))
-    x = det(d, xdiff) / div
-    y = det(d, ydiff) / div
-    return x, y
+def norm2d(vector):
+    return math.sqrt(vector[0] * vector[0] + vector[1] * vector[1])
 
 
 def center_point(point: tuple[float, float, float], center: tuple[float, float, float]):
@@ -1,5 +1,11 @@
+import bisect
+import multiprocessing
+
 import geopandas as g
+import numpy as np
 import pandas as p
+import shapely
+from rasterio.transform import Affine
 from shapely.geometry import Polygon, LineString, mapping
 
 from dataclasses import dataclass
@@ -12,6 +18,12 @@ LineStringList = list[LineString]
 CRS_degrees = 4326
 CRS_fr = 2154
 
+# Start method of the worker processes. The software runs in a multi-threaded process, and forking it can deadlock the
+# children, so they are started from a clean server process instead.
+process_start_method = (
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
 
 class GeoWindow:
     @classmethod
@@ -77,6 +89,26 @@ class GeoWindow:
         # Order is Xmin, Ymin, Xmax, Ymax
         self.bounds = self.dataframe.geometry[0].bounds
 
+        # Clipping with a rectangle window has a faster path than the general case
+        self.is_rectangle = self.dataframe.geometry[0].equals(
+            self.dataframe.geometry[0].envelope
+        )
+
+        # Window geometry prepared for fast containment tests
+        self.mask = self.dataframe.geometry[0]
+        shapely.prepare(self.mask)
+
+    def contains_xy(self, x, y) -> np.ndarray | bool:
+        """
+        Tests if points are strictly inside the window, as Point.within would
+        :param x: the x coordinates of the points, a number or an array
+        :param y: the y coordinates of the points, a number or an array
+        :return: for each point, True if it is inside the window
+        """
+        # The prepared state is not pickled, so it has to be rebuilt when the window is sent to another process
+        shapely.prepare(self.mask)
+        return shapely.contains_xy(self.mask, x, y)
+
 
 @dataclass
 class RenderingData:
@@ -116,6 +148,152 @@ class TerrainData:
 TerrainDataList = list[TerrainData]
 
 
+class TerrainMosaic:
+    """
+    Terrain of the whole scene, as one contiguous grid built from all the loaded slabs.
+    The first row of the grid is the northmost line of points, like in the slabs.
+    """
+
+    @classmethod
+    def from_slabs(cls, slabs: TerrainDataList):
+        """
+        Builds the mosaic covering all the slabs.
+        Parts of the mosaic that are not covered by any slab (sea slabs are not provided in RGEALTI) have a height of 0
+        and are flagged in the no data mask.
+        :param slabs: the slabs to assemble. They must have the same resolution and be aligned on the same grid.
+        :return: the mosaic
+        """
+        resolution = slabs[0].resolution
+
+        x_edges = sorted(set([x.x_min for x in slabs] + [x.x_max for x in slabs]))
+        y_edges = sorted(set([x.y_min for x in slabs] + [x.y_max for x in slabs]))
+
+        x_min = x_edges[0]
+        y_min = y_edges[0]
+        nbcol = round((x_edges[-1] - x_min) / resolution)
+        nbrow = round((y_edges[-1] - y_min) / resolution)
+
+        data = np.zeros((nbrow, nbcol), dtype=np.float32)
+        no_data_mask = np.ones((nbrow, nbcol), dtype=bool)
+
+        for slab in slabs:
+            col = round((slab.x_min - x_min) / resolution)
+            # Y axis is pointing north so the row index needs to be inversed
+            row = nbrow - round((slab.y_max - y_min) / resolution)
+
+            slab_values = np.asarray(slab.data.values)
+            mosaic_values = data[row : row + slab.nbrow, col : col + slab.nbcol]
+            mosaic_mask = no_data_mask[row : row + slab.nbrow, col : col + slab.nbcol]
+
+            # Slabs on the border of a departement are provided by both departements, each one having data only on
+            # its side of the border. Only points that have no data yet are written.
+            to_write = mosaic_mask & (slab_values != slab.no_data)
+            mosaic_values[to_write] = slab_values[to_write]
+            mosaic_mask[to_write] = False
+
+        return cls(data, no_data_mask, x_min, y_min, resolution, x_edges, y_edges)
+
+    def __init__(
+        self,
+        data: np.ndarray,
+        no_data_mask: np.ndarray,
+        x_min: float,
+        y_min: float,
+        resolution: float,
+        x_edges: list[float],
+        y_edges: list[float],
+    ):
+        self.data = data
+        self.no_data_mask = no_data_mask
+        self.resolution = resolution
+        self.nbrow, self.nbcol = data.shape
+
+        # Coordinates of the center of the lower left point, and of the upper right corner of the grid
+        self.x_min = x_min
+        self.y_min = y_min
+        self.x_max = x_min + resolution * self.nbcol
+        self.y_max = y_min + resolution * self.nbrow
+
+        # Maps (col, row) pixel coordinates to (x, y), with pixel centers at (col + 0.5, row + 0.5)
+        self.transform = Affine(
+            resolution,
+            0,
+            x_min - resolution / 2,
+            0,
+            -resolution,
+            self.y_max - resolution / 2,
+        )
+
+        # Boundaries of the slabs the mosaic was built from, including the missing ones.
+        self.x_edges = x_edges
+        self.y_edges = y_edges
+
+        # Order is Xmin, Ymin, Xmax, Ymax
+        self.slab_boxes = [
+            (x_edges[i], y_edges[j], x_edges[i + 1], y_edges[j + 1])
+            for j in range(len(y_edges) - 1)
+            for i in range(len(x_edges) - 1)
+        ]
+
+    def sample(self, xy: np.ndarray) -> np.ndarray:
+        """
+        Finds the heights of points using bilinear interpolation of the grid
+        :param xy: the (x,y) coordinates of the points, as an array of shape (N, 2)
+        :return: the heights of the points. Points outside of the grid have a height of 0.
+        """
+        xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+
+        is_inside = (
+            (xy[:, 0] >= self.x_min)
+            & (xy[:, 0] < self.x_max)
+            & (xy[:, 1] >= self.y_min)
+            & (xy[:, 1] < self.y_max)
+        )
+
+        # Position of the points in grid steps from the lower left point
+        grid_x = (
+            np.where(is_inside, xy[:, 0], self.x_min) - self.x_min
+        ) / self.resolution
+        grid_y = (
+            np.where(is_inside, xy[:, 1], self.y_min) - self.y_min
+        ) / self.resolution
+
+        # Clipped in case rounding puts points right below the upper bounds on them
+        col = np.minimum(np.floor(grid_x).astype(int), self.nbcol - 1)
+        step_y = np.minimum(np.floor(grid_y).astype(int), self.nbrow - 1)
+        offset_x = grid_x - col
+        offset_y = grid_y - step_y
+
+        # Y axis is pointing north so the row index needs to be inversed
+        row = self.nbrow - 1 - step_y
+
+        # Points beyond the last column or row have no neighbour on that side, the border heights are used
+        col_right = np.minimum(col + 1, self.nbcol - 1)
+        row_up = np.maximum(row - 1, 0)
+
+        z_low = (
+            self.data[row, col] * (1 - offset_x) + self.data[row, col_right] * offset_x
+        )
+        z_up = (
+            self.data[row_up, col] * (1 - offset_x)
+            + self.data[row_up, col_right] * offset_x
+        )
+
+        return np.where(is_inside, z_low * (1 - offset_y) + z_up * offset_y, 0)
+
+    def slab_index(self, x: float, y: float) -> int:
+        """
+        Finds the slab containing the (x,y) point
+        :param x: the x coordinate of the point
+        :param y: the y coordinate of the point
+        :return: the index of the slab in slab_boxes
+        """
+        slab_x = min(bisect.bisect_right(self.x_edges, x), len(self.x_edges) - 1) - 1
+        slab_y = min(bisect.bisect_right(self.y_edges, y), len(self.y_edges) - 1) - 1
+
+        return max(slab_y, 0) * (len(self.x_edges) - 1) + max(slab_x, 0)
+
+
 @dataclass
 class GeoData:
     buildings: g.GeoDataFrame
@@ -124,4 +302,4 @@ class GeoData:
     water: g.GeoDataFrame
     ocean: g.GeoDataFrame
     departements: g.GeoDataFrame
-    terrain: TerrainDataList
+    terrain: TerrainMosaic
@@ -17,7 +17,10 @@ from mage_procgen.Utils.DataFiles import (
     base_config_file,
     default_config_file,
     check_shapefiles_presence,
+    cache_folder,
+    rendering_data_cache_folder,
 )
+from mage_procgen.Utils.Cache import RenderingDataCache
 from mage_procgen.Loader.Loader import Loader
 from mage_procgen.Loader.ConfigLoader import ConfigLoader
 from mage_procgen.Processor.Preprocessor import Preprocessor
@@ -108,18 +111,39 @@ def main(filepath):
                 "Invalid config: invalid window type: ", config.window_type
             )
 
-    geo_data = Loader.load(config.base_folder, geo_window)
+    rendering_data_cache = None
+    cached_data = None
+    if config.rendering_data_cache_size > 0:
+        rendering_data_cache = RenderingDataCache(
+            os.path.join(config.base_folder, cache_folder, rendering_data_cache_folder),
+            config.rendering_data_cache_size * 1e6,
+        )
+        rendering_data_key = RenderingDataCache.key(
+            geo_window, config, Loader.input_files(config.base_folder, geo_window)
+        )
+        cached_data = rendering_data_cache.get(rendering_data_key)
+
+    if cached_data is not None:
+        print("Using cached preprocessing")
+        rendering_data, departements = cached_data
+        terrain = Loader.load_terrain(config.base_folder, geo_window, config)
+    else:
+        geo_data = Loader.load(config.base_folder, geo_window, config)
+
+        print("Files loaded")
+
+        print("Starting preprocessing")
+        processor = Preprocessor(geo_data, geo_window, config, CRS_fr)
+        rendering_data = processor.process()
+        print("Preprocessing done")
 
-    print("Files loaded")
+        departements = geo_data.departements
+        terrain = geo_data.terrain
 
-    print("Starting preprocessing")
-    processor = Preprocessor(geo_data, geo_window, config, CRS_fr)
-    rendering_data = processor.process()
-    print("Preprocessing done")
+        if rendering_data_cache is not None:
+            rendering_data_cache.put(rendering_data_key, rendering_data, departements)
 
-    render_manager = RenderManager(
-        geo_data.terrain, rendering_data, geo_window, CRS_fr, config
-    )
+    render_manager = RenderManager(terrain, rendering_data, geo_window, CRS_fr, config)
     render_manager.draw_flood_interactors()
 
     if not config.flood:
@@ -161,7 +185,7 @@ def main(filepath):
         render_manager.draw_flood(flood_data)
 
         if not config.export_img:
-            first_dpt_code = geo_data.departements["INSEE_DEP"][0]
+            first_dpt_code = departements["INSEE_DEP"][0]
 
             base_export_path = setup_export_folder(config.base_folder, first_dpt_code)
 
@@ -195,7 +219,7 @@ def main(filepath):
 
         if config.export_img:
 
-            first_dpt_code = geo_data.departements["INSEE_DEP"][0]
+            first_dpt_code = departements["INSEE_DEP"][0]
 
             base_export_path = setup_export_folder(config.base_folder, first_dpt_code)
 